@@ -0,0 +1,76 @@
+import argparse
+import json
+import re
+import time
+from os.path import join
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+from components.stt import Stt
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+def load_speech(path, samplerate):
+    data, data_sr = sf.read(path, dtype='float32')
+    if data.ndim > 1:
+        data = np.mean(data, axis=1)
+    return resample_poly(data, samplerate, data_sr).astype(np.float32)
+
+def normalize(text):
+    return re.sub(r"[^a-z0-9' ]", " ", text.lower()).split()
+
+def word_error_rate(reference, hypothesis):
+    reference, hypothesis = normalize(reference), normalize(hypothesis)
+    distances = list(range(len(hypothesis) + 1))
+    for i, ref_word in enumerate(reference, 1):
+        previous, distances[0] = distances[0], i
+        for j, hyp_word in enumerate(hypothesis, 1):
+            previous, distances[j] = distances[j], min(
+                distances[j] + 1,
+                distances[j - 1] + 1,
+                previous + (ref_word != hyp_word)
+                )
+    return distances[-1] / max(len(reference), 1)
+
+def time_call(fn, data, runs):
+    result = fn(data)
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn(data)
+    return result, (time.perf_counter() - start) / runs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stt accuracy and latency for the fp32 and quantized cpu profiles.")
+    parser.add_argument("--config", default="default.json", help="Path to JSON config file in the configs folder")
+    parser.add_argument("--audio", default=None, help="Speech file to transcribe, defaults to the Tts voice asset")
+    parser.add_argument("--reference", default=None, help="Reference transcript, defaults to the fp32 full model output")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per profile")
+    parser.add_argument("--distil_model", default="distil-whisper/distil-large-v3", help="Distilled checkpoint for the int8_distil profile")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    stt_params = config.get("Stt", {}).get("params", {})
+    tts_params = config.get("Tts", {}).get("params", {})
+    cpu_profile = stt_params.get('cpu_profile', None) or {}
+    audio_path = args.audio or tts_params.get('assets', None).get('voice_to_clone', None)
+
+    profiles = [
+        ("fp32", {}),
+        ("int8", dict(cpu_profile, model_name=None)),
+        ("int8_distil", dict(cpu_profile, model_name=args.distil_model)),
+        ]
+    reference = args.reference
+    print(f"{'profile':>12} {'latency_ms':>11} {'rtf':>6} {'wer':>6}")
+    for name, profile in profiles:
+        stt = Stt(params=dict(stt_params, device="cpu", cpu_profile=profile))
+        speech = load_speech(audio_path, stt.samplerate)
+        text, latency = time_call(stt.transcribe_translate, speech, args.runs)
+        if reference is None:
+            reference = text
+        rtf = latency * stt.samplerate / len(speech)
+        print(f"{name:>12} {latency*1000:>11.1f} {rtf:>6.2f} {word_error_rate(reference, text):>6.3f}")
+        del stt
@@ -0,0 +1,49 @@
+import argparse
+import json
+import time
+from os.path import join
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+from components.stt import Stt
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+def load_speech(path, samplerate):
+    data, data_sr = sf.read(path, dtype='float32')
+    if data.ndim > 1:
+        data = np.mean(data, axis=1)
+    return resample_poly(data, samplerate, data_sr).astype(np.float32)
+
+def time_call(fn, data, runs):
+    fn(data)
+    start = time.perf_counter()
+    for _ in range(runs):
+        fn(data)
+    return (time.perf_counter() - start) / runs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stt latency per clip length for the direct and chunked paths.")
+    parser.add_argument("--config", default="default.json", help="Path to JSON config file in the configs folder")
+    parser.add_argument("--lengths", default="1,2,3,5,8,12,20,30", help="Comma separated clip lengths in seconds")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per clip and path")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    stt_params = config.get("Stt", {}).get("params", {})
+    tts_params = config.get("Tts", {}).get("params", {})
+
+    stt = Stt(params=stt_params)
+    speech = load_speech(tts_params.get('assets', None).get('voice_to_clone', None), stt.samplerate)
+
+    print(f"{'length_s':>8} {'direct_ms':>10} {'chunked_ms':>11} {'speedup':>8}")
+    for length in [float(length) for length in args.lengths.split(",")]:
+        n_samples = int(length * stt.samplerate)
+        clip = np.resize(speech, n_samples)
+        direct = time_call(stt.transcribe_short, clip, args.runs)
+        chunked = time_call(stt.transcribe_long, clip, args.runs)
+        print(f"{length:>8.1f} {direct*1000:>10.1f} {chunked*1000:>11.1f} {chunked/direct:>8.2f}")
@@ -0,0 +1,77 @@
+import argparse
+import copy
+import json
+from os.path import join
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+from components.vad import Vad
+
+
+def load_config(config_file):
+    with open(config_file, "r") as file:
+        json_data = json.load(file)
+    return json_data
+
+def load_speech(path, samplerate):
+    data, data_sr = sf.read(path, dtype='float32')
+    if data.ndim > 1:
+        data = np.mean(data, axis=1)
+    return resample_poly(data, samplerate, data_sr).astype(np.float32)
+
+def make_conversation(speech, samplerate, turns, silence_sec, noise_db):
+    # turns of speech separated by room noise, the way the mic hears them between answers
+    rng = np.random.default_rng(0)
+    noise_rms = 10 ** (noise_db / 20)
+    parts = []
+    for _ in range(turns):
+        parts.append(rng.normal(0, noise_rms, int(silence_sec * samplerate)).astype(np.float32))
+        parts.append(speech + rng.normal(0, noise_rms, len(speech)).astype(np.float32))
+    parts.append(rng.normal(0, noise_rms, int(silence_sec * samplerate)).astype(np.float32))
+    return np.concatenate(parts)
+
+def run_vad(vad_params, audio, buffer_size):
+    vad = Vad(params=vad_params)
+    chunk_time = buffer_size / vad.samplerate
+    events = []
+    previous = None
+    for index in range(0, len(audio) - buffer_size + 1, buffer_size):
+        vad_status = vad.check(audio[index:index + buffer_size], chunk_time)
+        if vad_status is not None and previous is None:
+            events.append(("start", round(index / vad.samplerate, 3)))
+        if vad_status == "vad_end":
+            events.append(("end", round(index / vad.samplerate, 3)))
+        previous = None if vad_status == "vad_end" else vad_status
+    return vad, events
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Silero inferences skipped by the Vad pre_gate, and whether speech events move.")
+    parser.add_argument("--config", default="default.json", help="Path to JSON config file in the configs folder")
+    parser.add_argument("--audio", default=None, help="Speech clip, defaults to the Tts voice_to_clone asset")
+    parser.add_argument("--turns", type=int, default=5, help="Speech turns in the generated conversation")
+    parser.add_argument("--silence_sec", type=float, default=4, help="Silence before and between turns")
+    parser.add_argument("--noise_db", type=float, default=-55, help="Room noise level in dBFS")
+    args = parser.parse_args()
+
+    config = load_config(join("configs", args.config))
+    vad_params = config.get("Vad", {}).get("params", {})
+    mic_params = config.get("Mic", {}).get("params", {})
+    tts_params = config.get("Tts", {}).get("params", {})
+
+    audio_path = args.audio or tts_params.get('assets', None).get('voice_to_clone', None)
+    speech = load_speech(audio_path, vad_params.get('samplerate', None))
+    audio = make_conversation(speech, vad_params.get('samplerate', None), args.turns, args.silence_sec, args.noise_db)
+    buffer_size = mic_params.get('buffer_size', None)
+
+    results = {}
+    for enabled in [False, True]:
+        params = copy.deepcopy(vad_params)
+        params['pre_gate']['enabled'] = enabled
+        results[enabled] = run_vad(params, audio, buffer_size)
+
+    vad, events = results[True]
+    print(f"{'audio_s':>8} {'chunks':>7} {'skipped':>8} {'ratio':>6}")
+    print(f"{len(audio) / vad.samplerate:>8.1f} {vad.checked_chunks:>7} {vad.skipped_inferences:>8} {vad.skipped_inferences / vad.checked_chunks:>6.2f}")
+    print("events without gate:", results[False][1])
+    print("events with gate:   ", events)
+    print("identical:", results[False][1] == events)
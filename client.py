@@ -2,15 +2,16 @@ import argparse
 import json
 import time
 import threading
-from copy import deepcopy
+from collections import deque
 from os.path import join
-import numpy as np
 from components.nw import Nw
+from components.nw import FRAME_TEXT
+from components.nw import FRAME_AUDIO
+from components.nw import decode_text
 from components.ap import Ap
 from components.mic import Mic
+from components.vad import Vad
 from components.ui import Ui
-from components.utils import find_code_blocks
-# import scipy.io.wavfile as wf
 
 
 def load_config(config_file):
@@ -18,7 +19,25 @@ def load_config(config_file):
         json_data = json.load(file)
     return json_data
 
-def main(nw, ui, mic, ap, vad_params, llm_params):
+def receive_answer(nw, ui, ap, cancel=None):
+    # after a barge-in the rest of the answer is still read up to its end frame, but dropped
+    while True:
+        frame_type, payload = nw.receive_frame()
+        cancelled = cancel is not None and cancel.is_set()
+        if frame_type == FRAME_TEXT:
+            if not cancelled:
+                llm_data, kind = decode_text(payload)
+                ui.add_message("Aria", llm_data, new_entry=False, kind=kind)
+        elif frame_type == FRAME_AUDIO:
+            if not cancelled:
+                ap.stream_sound(nw.decode_audio(payload), update_ui=True)
+        else:
+            break
+    if cancel is None or not cancel.is_set():
+        ap.check_audio_finished()
+        ap.play_sound(ap.listening_sound)
+
+def main(nw, ui, mic, ap, vad, voice=None):
     nw.client_init()
     ui.add_message("system", "Connecting...", new_entry=False)
     print('Connecting...')
@@ -28,6 +47,9 @@ def main(nw, ui, mic, ap, vad_params, llm_params):
             break
         except:
             time.sleep(1)
+    if voice is not None:
+        nw.send_control("voice")
+        nw.send_text(voice)
     ui.add_message("system", "\nConnected!", new_entry=False)
     print("Connected!")
     
@@ -35,130 +57,137 @@ def main(nw, ui, mic, ap, vad_params, llm_params):
     ui.load_visual("You")
     
     mic_muted = False
-    mic_last_chunk = None
+    utterance_streamed = False
+    # barge-in needs the client side vad, the mic then stays open while Aria speaks
+    barge_in = vad is not None and vad.barge_in.get('enabled', None)
+    answer_thread = None
+    cancel = None
+    speech_chunks = []
+    if vad is not None:
+        preroll = deque(maxlen=int(vad.preroll_ms / 1000 * mic.samplerate / mic.buffer_size) + 1)
     mic.start_mic()
     
     while True:
-        skip_sleep = False
         if ui.kill:
             print("Shutting down...")
+            if cancel is not None:
+                cancel.set()
+            if vad is not None and vad.pre_gate.enabled:
+                print("VAD inferences skipped by pre-gate:", vad.skipped_inferences, "of", vad.checked_chunks)
+            print("Playback underruns:", ap.underruns, "device underflows:", ap.device_underruns)
             break
-        mic_chunk = mic.get_chunk()
-        if len(mic_chunk) == mic.buffer_size:
-            if max(mic_chunk) == 0 and not mic_muted:
+        mic_chunk = mic.get_chunk(timeout=0.1)
+        if mic_chunk is not None:
+            if mic_chunk.max() == 0 and not mic_muted:
                 mic_muted = True
                 mic.update_ui = False
                 ui.load_visual("system_muted_mic")
-                nw.send_msg("reset_vad")
-                nw.receive_ack()
+                if vad is not None:
+                    vad.reset_vad()
+                    preroll.clear()
+                    if utterance_streamed:
+                        nw.send_control("utterance_reset")
+                        utterance_streamed = False
+                else:
+                    nw.send_control("reset_vad")
                 mic.reset_recording()
-                skip_sleep = True
-            elif not (mic_chunk==mic_last_chunk).all() and max(mic_chunk) != 0:
+            elif mic_chunk.max() != 0:
                 if mic_muted:
                     ui.load_visual("You")
                     mic.update_ui = True
                     mic_muted = False
-                mic_last_chunk = deepcopy(mic_chunk)
-                nw.send_msg("vad_time")
-                vad_time = nw.receive_msg()
-                mic.vad_time = float(vad_time)
-                nw.send_msg("vad_check")
-                nw.receive_ack()
-                nw.send_audio(mic_chunk.tobytes())
-                vad_status = nw.receive_msg()
-                if vad_status == 'None':
+                if vad is not None:
+                    chunk_time = mic.buffer_size / mic.samplerate
+                    if answer_thread is not None and answer_thread.is_alive() and not cancel.is_set():
+                        # Aria is speaking, her own voice must not open a turn
+                        vad_status, barged_in = vad.check_barge_in(mic_chunk, chunk_time, ap.output_level)
+                        if not barged_in:
+                            if vad_status is None:
+                                preroll.extend(speech_chunks)
+                                preroll.append(mic_chunk)
+                                speech_chunks = []
+                            else:
+                                speech_chunks.append(mic_chunk)
+                            continue
+                        # the server stops llama.cpp and xtts, playback stops here right away
+                        nw.send_control("cancel")
+                        cancel.set()
+                        ap.clear()
+                        ap.check_audio_finished()
+                        ui.load_visual("You")
+                        mic.update_ui = True
+                        for speech_chunk in list(preroll) + speech_chunks:
+                            nw.send_control("utterance_chunk")
+                            nw.send_audio(speech_chunk)
+                        preroll.clear()
+                        speech_chunks = []
+                        utterance_streamed = True
+                    else:
+                        if answer_thread is not None and not cancel.is_set():
+                            answer_thread = None
+                            vad.reset_vad()
+                            ui.load_visual("You")
+                            mic.update_ui = True
+                        mic.vad_time = vad.no_voice_wait_sec - vad.no_voice_sec
+                        vad_status = vad.check(mic_chunk, chunk_time)
+                    if vad_status is not None:
+                        if not utterance_streamed:
+                            for preroll_chunk in preroll:
+                                nw.send_control("utterance_chunk")
+                                nw.send_audio(preroll_chunk)
+                            preroll.clear()
+                        nw.send_control("utterance_chunk")
+                        nw.send_audio(mic_chunk)
+                        utterance_streamed = True
+                    else:
+                        preroll.append(mic_chunk)
+                        if utterance_streamed:
+                            nw.send_control("utterance_reset")
+                            utterance_streamed = False
+                else:
+                    nw.send_control("vad_check")
+                    nw.send_audio(mic_chunk)
+                    vad_status = nw.receive_control()
+                    mic.vad_time = float(nw.receive_text())
+                    if vad_status == 'None':
+                        vad_status = None
+                if vad_status is None:
                     mic.reset_recording()
-                    skip_sleep = True
                 elif vad_status == "vad_end":
-                    mic.stop_mic()
+                    if not barge_in:
+                        mic.stop_mic()
+                    if vad is not None:
+                        nw.send_control("utterance_end")
+                        utterance_streamed = False
                     ui.load_visual("system_transition")
                     ap.play_sound(ap.transition_sound)
-                    mic_recording = mic.get_recording()
-                    vad_no_voice_wait_sec = vad_params.get('no_voice_wait_sec', None)
-                    mic_recording = mic_recording[:-vad_no_voice_wait_sec*mic.samplerate]
-                    # wf.write('test.wav', mic.samplerate, mic_recording)
-                    nw.send_msg("stt_transcribe")
-                    nw.receive_ack()
-                    nw.send_msg(str(len(mic_recording.tobytes())))
-                    nw.receive_ack()
-                    nw.send_audio(mic_recording.tobytes())
-                    stt_data = nw.receive_msg()
+                    if answer_thread is not None:
+                        # the interrupted answer is read to its end frame before the transcript
+                        answer_thread.join()
+                        answer_thread = None
+                    stt_data = nw.receive_text()
                     if len(stt_data) != 1:
                         ui.add_message("You", stt_data, new_entry=True)
-                        nw.send_msg("llm_get_answer")
-                        if not llm_params.get('streaming_output', None):
-                            llm_data_size = nw.receive_msg()
-                            nw.send_ack()
-                            llm_data = nw.receive_msg(int(llm_data_size), waitall=True)
-                            code_blocks = find_code_blocks(llm_data)
-                            if len(code_blocks) > 0:
-                                color_code_block = True
-                            else:
-                                color_code_block = False
-                            ui.add_message("Aria", llm_data, new_entry=True, color_code_block=color_code_block, code_blocks=code_blocks)
-                            while True:
-                                nw.send_ack()
-                                tts_chunk_size = nw.receive_msg()
-                                if tts_chunk_size == "tts_end":
-                                    break
-                                else:
-                                    nw.send_ack()
-                                    tts_chunk = nw.receive_audio(int(tts_chunk_size))
-                                    ap.stream_sound(np.frombuffer(tts_chunk, np.float32).flatten(), update_ui=True)
-                            ap.check_audio_finished()
-                        else:
-                            nw.receive_ack()
-                            ui.add_message("Aria", "", new_entry=True)
-                            while True:
-                                nw.send_ack()
-                                llm_or_tts = nw.receive_msg()
-                                if llm_or_tts == "llm":
-                                    nw.send_ack()
-                                    llm_chunk_size = nw.receive_msg()
-                                    nw.send_ack()
-                                    llm_chunk = nw.receive_msg(int(llm_chunk_size), waitall=True)
-                                    nw.send_ack()
-                                    color_code_block = nw.receive_msg()
-                                    ui.add_message("Aria", llm_chunk, new_entry=False, color_code_block=color_code_block.lower()=='true')
-                                elif llm_or_tts == "tts":
-                                    while True:
-                                        nw.send_ack()
-                                        tts_chunk_size = nw.receive_msg()
-                                        if tts_chunk_size == "tts_end":
-                                            break
-                                        else:
-                                            nw.send_ack()
-                                            tts_chunk = nw.receive_audio(int(tts_chunk_size))
-                                            ap.stream_sound(np.frombuffer(tts_chunk, np.float32).flatten(), update_ui=True)
-                                elif llm_or_tts == "streaming_end":
-                                    break
-                            ap.check_audio_finished()
+                        nw.send_control("llm_get_answer")
+                        ui.add_message("Aria", "", new_entry=True)
                     else:
                         # TODO add to llm context
                         ui.add_message("You", "...", new_entry=True)
-                        nw.send_msg("fixed_answer")
+                        nw.send_control("fixed_answer")
                         ui.add_message("Aria", "Did you say something?", new_entry=True)
-                        while True:
-                            nw.send_ack()
-                            tts_chunk_size = nw.receive_msg()
-                            if tts_chunk_size == "tts_end":
-                                break
-                            else:
-                                nw.send_ack()
-                                tts_chunk = nw.receive_audio(int(tts_chunk_size))
-                                ap.stream_sound(np.frombuffer(tts_chunk, np.float32).flatten(), update_ui=True)
-                        ap.check_audio_finished()
-                    time.sleep(1)
-                    ap.play_sound(ap.listening_sound)
-                    ui.load_visual("You")
-                    mic.start_mic()
-                    skip_sleep = True
+                    if barge_in:
+                        mic.update_ui = False
+                        cancel = threading.Event()
+                        answer_thread = threading.Thread(target=receive_answer, args=(nw, ui, ap, cancel), daemon=True)
+                        answer_thread.start()
+                    else:
+                        receive_answer(nw, ui, ap)
+                        ui.load_visual("You")
+                        mic.start_mic()
                 else:
                     pass
             else:
                 pass
-        if not skip_sleep:
-            time.sleep(mic.buffer_size / mic.samplerate)        
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Aria.")
@@ -173,14 +202,15 @@ if __name__ == "__main__":
     mic_params = config.get("Mic", {}).get("params", {})
     ui_params = config.get("Ui", {}).get("params", {})
     vad_params = config.get("Vad", {}).get("params", {})
-    llm_params = config.get("Llm", {}).get("params", {})
+    tts_params = config.get("Tts", {}).get("params", {})
     
     nw = Nw(params=nw_params)
     ui = Ui(params=ui_params)
     ap = Ap(params=ap_params, ui=ui)
     mic = Mic(params=mic_params, ui=ui, vad_params=vad_params)
+    vad = Vad(params=vad_params) if vad_params.get('client_side', None) else None
     
-    com_thread = threading.Thread(target=main, args=(nw, ui, mic, ap, vad_params, llm_params))
+    com_thread = threading.Thread(target=main, args=(nw, ui, mic, ap, vad, tts_params.get('voice', None)))
     com_thread.start()
     
     ui.start()
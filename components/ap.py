@@ -1,5 +1,5 @@
-import time
-from copy import deepcopy
+import threading
+from collections import deque
 import pyaudio
 import numpy as np
 import soundfile as sf
@@ -22,7 +22,23 @@ class Ap:
         self.ui = ui
         self.update_ui = False
         self.load_visual_once = True
-        self.audio_buffer = None    
+        self.output_level = 0.0
+        # queued chunks are played straight from the arrays handed in, never copied together
+        self.chunks = deque()
+        self.read_pos = 0
+        self.queued_samples = 0
+        # more audio is expected until check_audio_finished or clear says the answer is complete
+        self.streaming = False
+        self.starved = False
+        self.underruns = 0
+        self.device_underruns = 0
+        self.out = np.zeros(self.buffer_size, dtype=np.float32)
+        self.lock = threading.Lock()
+        # set from the callback once the device has played the last queued sample
+        self.drained = threading.Event()
+        self.drained.set()
+        self.frames_out = 0
+        self.drain_frame = None
             
         p = pyaudio.PyAudio()
         self.stream = p.open(format=self.sample_format,
@@ -33,27 +49,59 @@ class Ap:
                         output_device_index=self.audio_device,
                         stream_callback=self._callback
                         )
+        self.latency_frames = int(self.stream.get_output_latency() * self.samplerate)
         
         self.listening_sound, self.listening_sound_sr = sf.read(self.listening_sound_path)
         self.transition_sound, self.transition_sound_sr = sf.read(self.transition_sound_path)
         
     def _callback(self, in_data, frame_count, time_info, status):
-        if self.audio_buffer is None:
-            data = np.zeros(frame_count)
-        elif len(self.audio_buffer) >= frame_count:
-            data = self.audio_buffer[:frame_count]
-            self.audio_buffer = self.audio_buffer[frame_count:]
-        else:
-            shortfall = frame_count - len(self.audio_buffer)
-            data = np.concatenate((self.audio_buffer, np.zeros(shortfall, dtype=np.float32)))
-            self.audio_buffer = None
+        if status & pyaudio.paOutputUnderflow:
+            self.device_underruns += 1
+        if frame_count > len(self.out):
+            self.out = np.zeros(frame_count, dtype=np.float32)
+        data = self.out[:frame_count]
+        filled = 0
+        with self.lock:
+            # copies at most one frame, however much is queued
+            while filled < frame_count and self.chunks:
+                chunk = self.chunks[0]
+                n_samples = min(frame_count - filled, len(chunk) - self.read_pos)
+                data[filled:filled + n_samples] = chunk[self.read_pos:self.read_pos + n_samples]
+                filled += n_samples
+                self.read_pos += n_samples
+                if self.read_pos == len(chunk):
+                    self.chunks.popleft()
+                    self.read_pos = 0
+            self.queued_samples -= filled
+            if filled < frame_count and self.streaming and not self.starved:
+                # tts fell behind playback, counted once until audio arrives again
+                self.starved = True
+                self.underruns += 1
+            if self.chunks:
+                self.drain_frame = None
+            elif filled > 0:
+                # the last queued sample is heard once the device is past this frame and its latency
+                self.drain_frame = self.frames_out + filled + self.latency_frames
+            elif self.drain_frame is not None and self.frames_out >= self.drain_frame:
+                self.drain_frame = None
+                self.drained.set()
+            self.frames_out += frame_count
+        data[filled:] = 0
+        # peak-hold of what is playing, decaying so the room echo tail is still covered
+        self.output_level = max(float(np.sqrt(np.dot(data, data) / frame_count)), 0.8 * self.output_level)
         if self.update_ui:
             self.ui.update_visual("Aria", data)
         return (data.tobytes(), pyaudio.paContinue)
     
+    def wait_finished(self, timeout=None):
+        return self.drained.wait(timeout)
+
     def check_audio_finished(self):
-        if self.audio_buffer is not None:
-            time.sleep(len(self.audio_buffer) / self.samplerate)
+        self.streaming = False
+        # audio queued while waiting is waited for too, a stalled stream does not hang the caller
+        while not self.wait_finished(timeout=0.5):
+            if not self.stream.is_active():
+                break
         self.update_ui = False
         self.load_visual_once = True
         
@@ -62,14 +110,28 @@ class Ap:
             self.ui.load_visual("Aria")
             self.load_visual_once = False
         self.update_ui = update_ui
-        if self.audio_buffer is None:
-            self.audio_buffer = deepcopy(chunk)
-        else:
-            self.audio_buffer = np.concatenate((self.audio_buffer, chunk))
+        # the chunk is queued as is, callers must not write to it afterwards
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+        if len(chunk) == 0:
+            return
+        with self.lock:
+            self.chunks.append(chunk)
+            self.queued_samples += len(chunk)
+            self.streaming = True
+            self.starved = False
+            self.drain_frame = None
+            self.drained.clear()
+
+    def clear(self):
+        # drops everything not yet played, the output goes silent on the next callback
+        with self.lock:
+            self.chunks.clear()
+            self.read_pos = 0
+            self.queued_samples = 0
+            self.streaming = False
+            self.drain_frame = None
+            self.drained.set()
         
     def play_sound(self, sound):
-        for chunk_index in range(0, len(sound), self.buffer_size):
-            chunk = sound[chunk_index:chunk_index + self.buffer_size]
-            chunk = np.mean(chunk, axis=1)
-            self.stream_sound(chunk.astype('float32'))
+        self.stream_sound(np.mean(sound, axis=1).astype('float32'))
         self.check_audio_finished()
@@ -0,0 +1,62 @@
+import zlib
+import numpy as np
+
+
+MULAW_MU = 255
+
+
+def encode_float32(data):
+    return np.asarray(data, dtype=np.float32).tobytes()
+
+
+def decode_float32(payload):
+    return np.frombuffer(payload, np.float32)
+
+
+def encode_int16(data):
+    data = np.clip(np.asarray(data, dtype=np.float32), -1.0, 1.0)
+    return (data * 32767).astype('<i2').tobytes()
+
+
+def decode_int16(payload):
+    return np.frombuffer(payload, '<i2').astype(np.float32) / 32767
+
+
+def encode_int16_zlib(data):
+    data = np.clip(np.asarray(data, dtype=np.float32), -1.0, 1.0)
+    samples = (data * 32767).astype('<i2')
+    # first order delta wraps around in int16, so it stays lossless
+    deltas = np.diff(samples, prepend=np.int16(0))
+    return zlib.compress(deltas.tobytes(), 1)
+
+
+def decode_int16_zlib(payload):
+    deltas = np.frombuffer(zlib.decompress(payload), '<i2')
+    return np.cumsum(deltas, dtype='<i2').astype(np.float32) / 32767
+
+
+def encode_mulaw(data):
+    data = np.clip(np.asarray(data, dtype=np.float32), -1.0, 1.0)
+    companded = np.sign(data) * np.log1p(MULAW_MU * np.abs(data)) / np.log1p(MULAW_MU)
+    return np.rint((companded + 1) * 127.5).astype(np.uint8).tobytes()
+
+
+def decode_mulaw(payload):
+    companded = np.frombuffer(payload, np.uint8).astype(np.float32) / 127.5 - 1
+    return (np.sign(companded) * np.expm1(np.abs(companded) * np.log1p(MULAW_MU)) / MULAW_MU).astype(np.float32)
+
+
+AUDIO_ENCODINGS = {
+    'float32': (encode_float32, decode_float32),
+    'int16': (encode_int16, decode_int16),
+    'int16_zlib': (encode_int16_zlib, decode_int16_zlib),
+    'mulaw': (encode_mulaw, decode_mulaw),
+}
+
+
+def encode_audio(data, encoding):
+    return AUDIO_ENCODINGS[encoding][0](data)
+
+
+def decode_audio(payload, encoding):
+    return AUDIO_ENCODINGS[encoding][1](payload)
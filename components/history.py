@@ -0,0 +1,104 @@
+import threading
+from collections import deque
+
+
+class ChatHistory:
+    def __init__(self, llm, lock, system_message, params=None):
+        self.params = params or {}
+        self.history_tokens = self.params.get('history_tokens', None)
+        self.evict_to_tokens = self.params.get('evict_to_tokens', None)
+        self.summary_tokens = self.params.get('summary_tokens', None)
+        self.summary_prompt = self.params.get('summary_prompt', None)
+        self.llm = llm
+        self.lock = lock
+        self.system_message = system_message
+
+        self.turns = deque()
+        self.turn_tokens = 0
+        self.summary = ""
+        self.summary_token_count = 0
+        self._summarizing = False
+        self._state_lock = threading.Lock()
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode(), add_bos=False))
+
+    def append(self, message):
+        # token counts are computed once per message and kept with it
+        n_tokens = self.count_tokens(message["content"])
+        with self._state_lock:
+            self.turns.append((message, n_tokens))
+            self.turn_tokens += n_tokens
+
+    def compact(self):
+        # called once the answer is out and the generation lock is free, never before a completion
+        with self._state_lock:
+            if self.turn_tokens + self.summary_token_count > self.history_tokens and not self._summarizing:
+                self._summarizing = True
+                threading.Thread(target=self._summarize, daemon=True).start()
+
+    def _select_evicted(self):
+        # whole user/assistant pairs from the front, down to evict_to_tokens so that the
+        # prompt prefix (and with it the prefix cache) only changes every few turns
+        n_evicted = 0
+        n_tokens = self.turn_tokens + self.summary_token_count
+        while n_tokens > self.evict_to_tokens:
+            n_pair = 1
+            if n_evicted + 1 < len(self.turns) and self.turns[n_evicted + 1][0]["role"] == "assistant":
+                n_pair = 2
+            # the newest pair always stays
+            if n_evicted + n_pair >= len(self.turns):
+                break
+            n_tokens -= sum(self.turns[n_evicted + i][1] for i in range(n_pair))
+            n_evicted += n_pair
+        return n_evicted
+
+    def messages(self):
+        with self._state_lock:
+            system_message = self.system_message
+            if self.summary:
+                system_message += "\n\nSummary of the earlier conversation: " + self.summary
+            return [{"role": "system", "content": system_message}] + [message for message, _ in self.turns]
+
+    def _summarize(self):
+        try:
+            while self._summarize_evicted():
+                pass
+        finally:
+            with self._state_lock:
+                self._summarizing = False
+
+    def _summarize_evicted(self):
+        # evicted turns stay in the prompt until their summary is ready, then both change at once
+        with self._state_lock:
+            n_evicted = self._select_evicted()
+            if self.turn_tokens + self.summary_token_count <= self.history_tokens or n_evicted == 0:
+                return False
+            evicted = [self.turns[i][0] for i in range(n_evicted)]
+            summary = self.summary
+        transcript = "\n".join(message["role"] + ": " + message["content"] for message in evicted)
+        prompt = [
+            {
+                "role": "system",
+                "content": self.summary_prompt
+            },
+            {
+                "role": "user",
+                "content": "Summary so far: " + (summary or "none") + "\n\nConversation:\n" + transcript
+            }
+        ]
+        try:
+            with self.lock:
+                output = self.llm.create_chat_completion(prompt, max_tokens=self.summary_tokens)
+            summary = output["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            # the turns are dropped anyway, so the history still stays within its budget
+            print("History summary failed:", repr(e))
+        n_tokens = self.count_tokens(summary)
+        with self._state_lock:
+            # only appends happen meanwhile, so the evicted turns are still at the front
+            for _ in range(n_evicted):
+                self.turn_tokens -= self.turns.popleft()[1]
+            self.summary = summary
+            self.summary_token_count = n_tokens
+        return True
@@ -1,7 +1,15 @@
 import sys
+import os
+import threading
 from llama_cpp import Llama
 from huggingface_hub import hf_hub_download
+from .history import ChatHistory
+from .llm_cache import PrefixCache
 from .utils import remove_emojis
+from .utils import PipelineStage
+from .utils import SentenceSegmenter
+from .utils import remove_multiple_dots
+from .utils import MarkdownStream
 
 
 class Llm:
@@ -14,6 +22,11 @@ class Llm:
         self.streaming_output = self.params.get('streaming_output', None)
         self.chat_format = self.params.get('chat_format', None)
         self.system_message = self.params.get('system_message', None)
+        self.context = self.params.get('context', None) or {}
+        self.prompt_cache = self.params.get('prompt_cache', None) or {}
+        self.speculative_prefill = self.params.get('speculative_prefill', None)
+        self.tts_queue_size = self.params.get('tts_queue_size', None)
+        self.segmenter = self.params.get('segmenter', None) or {}
         self.verbose = self.params.get('verbose', None)
        
         model_path = hf_hub_download(self.model_name, filename=self.model_file)
@@ -25,15 +38,60 @@ class Llm:
                     chat_format=self.chat_format,
                     verbose=self.verbose
                     )
+        self.lock = threading.Lock()
+        self.cache = None
+        if self.prompt_cache.get('enabled', None):
+            namespace = "{}-{}".format(os.path.splitext(self.model_file)[0], self.context_length)
+            self.cache = PrefixCache(self.llm, namespace, params=self.prompt_cache)
+            self.llm.set_cache(self.cache)
+            self.warm_up()
 
-        self.messages = [
-                {
-                    "role": "system", 
-                    "content": self.system_message
-                }
-            ]
+        self.messages = ChatHistory(self.llm, self.lock, self.system_message, params=self.context)
 
-    def get_answer(self, ui, ap, tts, data):
+    def warm_up(self):
+        # evaluates the system prompt once so every conversation resumes from its cached state
+        with self.lock:
+            self.llm.create_chat_completion(
+                [
+                    {
+                        "role": "system",
+                        "content": self.system_message
+                    }
+                ],
+                max_tokens=1
+                )
+
+    def prefill(self, text):
+        # speculative: evaluates the partial user turn so get_answer only processes what changed since
+        if len(text) == 0 or not self.lock.acquire(blocking=False):
+            return
+        messages = self.messages.messages() + [
+            {
+                "role": "user",
+                "content": text
+            }
+        ]
+        try:
+            self.llm.set_cache(None)
+            self.llm.create_chat_completion(messages, max_tokens=1)
+        finally:
+            self.llm.set_cache(self.cache)
+            self.lock.release()
+
+    def show_and_speak(self, ui, spans, segmenter, tts_stage, final=False):
+        sentences = []
+        for kind, text in spans:
+            ui.add_message("Aria", text, new_entry=False, kind=kind)
+            # code is shown but never spoken, the prose before it is voiced right away
+            sentences += segmenter.flush() if kind == "code" else segmenter.feed(text)
+        if final:
+            sentences += segmenter.flush()
+        for sentence in sentences:
+            txt_for_tts = remove_emojis(remove_multiple_dots(sentence))
+            if len(txt_for_tts) > 1 and not all(char.isspace() for char in txt_for_tts):
+                tts_stage.put(txt_for_tts)
+
+    def get_answer(self, ui, ap, tts, data, cancel=None):
         self.messages.append(
             {
                 "role": "user", 
@@ -41,59 +99,38 @@ class Llm:
             }
         )
     
-        outputs = self.llm.create_chat_completion(
-            self.messages,
-            stream=self.streaming_output
-            )
+        # sentences are voiced on their own thread while generation continues
+        with PipelineStage(lambda text: tts.run_tts(text, cancel=cancel), maxsize=self.tts_queue_size) as tts_stage:
+            with self.lock:
+                outputs = self.llm.create_chat_completion(
+                    self.messages.messages(),
+                    stream=self.streaming_output
+                    )
         
-        if self.streaming_output:
-            llm_output = ""
-            tts_text_buffer = []
-            color_code_block = False
-            backticks = 0
-            skip_code_block_on_tts = False
-            ui.add_message("Aria", "", new_entry=True)
-            for i, out in enumerate(outputs):
-                if "content" in out['choices'][0]["delta"]:
-                    output_chunk_txt = out['choices'][0]["delta"]['content']
-                    if output_chunk_txt == "``" and backticks == 0:
-                        skip_code_block_on_tts = not skip_code_block_on_tts
-                        color_code_block = not color_code_block
-                        backticks += 2
-                    if backticks > 0 and backticks <= 3:
-                        backticks += 1
+                if self.streaming_output:
+                    llm_output = ""
+                    markdown = MarkdownStream()
+                    segmenter = SentenceSegmenter(params=self.segmenter)
+                    ui.add_message("Aria", "", new_entry=True)
+                    print('Aria:', end=' ')
+                    for out in outputs:
+                        if cancel is not None and cancel.is_set():
+                            # llama.cpp stops at the next token, the part already said stays in the history
+                            break
+                        if "content" in out['choices'][0]["delta"]:
+                            output_chunk_txt = out['choices'][0]["delta"]['content']
+                            print(output_chunk_txt, end='')
+                            sys.stdout.flush()
+                            llm_output += output_chunk_txt
+                            self.show_and_speak(ui, markdown.feed(output_chunk_txt), segmenter, tts_stage)
                     else:
-                        backticks = 0
-                    if i == 1:
-                        print('Aria:', output_chunk_txt.strip(), end='')
-                        if backticks == 0:
-                            ui.add_message("Aria", output_chunk_txt.strip(), new_entry=False, color_code_block=color_code_block)
-                    else:
-                        print(output_chunk_txt, end='')
-                        if backticks == 0:
-                            ui.add_message("Aria", output_chunk_txt, new_entry=False, color_code_block=color_code_block)
-                    sys.stdout.flush()
-                    llm_output += output_chunk_txt
-                    if not skip_code_block_on_tts:
-                        tts_text_buffer.append(output_chunk_txt)
-                        if tts_text_buffer[-1] in [".", "!", "?", ":", "..", "..."]:
-                            # TODO handle float numbers
-                            # TODO remove multi dots
-                            # TODO handle emphasis
-                            txt_for_tts = remove_emojis("".join(tts_text_buffer).strip())
-                            if len(txt_for_tts) > 1 and not all(char.isspace() for char in txt_for_tts):
-                                tts.run_tts(txt_for_tts)
-                            tts_text_buffer = []
-            if not skip_code_block_on_tts and len(tts_text_buffer) != 0:
-                # TODO remove multi dots
-                txt_for_tts = remove_emojis("".join(tts_text_buffer).strip())
-                if len(txt_for_tts) > 1 and not all(char.isspace() for char in txt_for_tts):
-                    tts.run_tts(txt_for_tts)
+                        self.show_and_speak(ui, markdown.flush(), segmenter, tts_stage, final=True)
+                    print()
+                    llm_output = llm_output.strip()
+                else:
+                    llm_output = outputs["choices"][0]["message"]["content"].strip()
+        if self.streaming_output:
             ap.check_audio_finished()
-            print()
-            llm_output = llm_output.strip()
-        else:
-            llm_output = outputs["choices"][0]["message"]["content"].strip()
 
         self.messages.append(
             {
@@ -101,5 +138,7 @@ class Llm:
                 "content": llm_output
             }
         )
+        # the summary of dropped turns is generated only now, off the answer's critical path
+        self.messages.compact()
         
         return llm_output
\ No newline at end of file
@@ -0,0 +1,168 @@
+import copy
+import hashlib
+import json
+import os
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp import LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache
+
+
+class RestoredScores:
+    # Llama.load_state only calls scores.copy(), so the saved rows are written into the
+    # model's own scores buffer instead of allocating an n_ctx x n_vocab array per hit
+    def __init__(self, cache, state, reused_tokens):
+        self.cache = cache
+        self.state = state
+        self.reused_tokens = reused_tokens
+
+    def copy(self):
+        scores = self.cache.llm.scores
+        scores[self.state.n_tokens - len(self.state.scores):self.state.n_tokens] = self.state.scores
+        self.cache.hits += 1
+        self.cache.reused_tokens += self.reused_tokens
+        return scores
+
+
+class PrefixCache(BaseLlamaCache):
+    def __init__(self, llm, namespace, params=None):
+        self.params = params or {}
+        self.ram_bytes = int(self.params.get('ram_mb', None) * 2**20)
+        self.disk_bytes = int(self.params.get('disk_mb', None) * 2**20)
+        self.max_pending_writes = self.params.get('max_pending_writes', None)
+        self.cache_dir = os.path.join(os.path.expanduser(self.params.get('cache_dir', None)), namespace)
+        super().__init__(capacity_bytes=self.ram_bytes)
+        self.llm = llm
+
+        self.ram = OrderedDict()
+        self.disk = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.reused_tokens = 0
+        self.dropped_writes = 0
+        self._disk_lock = threading.Lock()
+        self._writes = queue.Queue(maxsize=self.max_pending_writes)
+        if self.disk_bytes > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_index()
+            threading.Thread(target=self._write_disk, daemon=True).start()
+
+    @property
+    def cache_size(self):
+        return sum(state.llama_state_size + state.scores.nbytes for state in self.ram.values())
+
+    def _find_longest_prefix_key(self, key):
+        best_len = 0
+        best_key = None
+        with self._disk_lock:
+            keys = list(self.ram.keys()) + list(self.disk.keys())
+        for k in keys:
+            prefix_len = Llama.longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = k
+        return best_key
+
+    def __contains__(self, key):
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        self.lookups += 1
+        best_key = self._find_longest_prefix_key(key)
+        if best_key is None:
+            raise KeyError("Key not found")
+        if best_key in self.ram:
+            self.ram.move_to_end(best_key)
+            state = self.ram[best_key]
+        else:
+            state = self._read_disk(best_key)
+            self._put_ram(best_key, state)
+        # llama-cpp only loads the state when it beats its current context, hits are counted then
+        return self._restore(state, Llama.longest_token_prefix(best_key, key))
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        state = self._compact(value)
+        self._put_ram(key, state)
+        if self.disk_bytes > 0:
+            try:
+                self._writes.put_nowait((key, state))
+            except queue.Full:
+                # the disk tier is best effort, a slow disk never holds unwritten states in memory
+                self.dropped_writes += 1
+
+    def _compact(self, state):
+        # without logits_all only the last row of scores is ever read, the rest is an n_ctx x n_vocab copy
+        compact = copy.copy(state)
+        compact.scores = state.scores[max(state.n_tokens - 1, 0):state.n_tokens].copy()
+        return compact
+
+    def _restore(self, state, reused_tokens):
+        restored = copy.copy(state)
+        restored.scores = RestoredScores(self, state, reused_tokens)
+        return restored
+
+    def _put_ram(self, key, state):
+        self.ram.pop(key, None)
+        self.ram[key] = state
+        while self.cache_size > self.ram_bytes and len(self.ram) > 1:
+            self.ram.popitem(last=False)
+
+    def _state_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(np.asarray(key, dtype=np.int32).tobytes()).hexdigest() + '.npz')
+
+    def _load_index(self):
+        # the index is plain json and the states plain arrays, nothing on disk is unpickled
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as file:
+                entries = json.load(file)
+            self.disk = OrderedDict((tuple(key), n_bytes) for key, n_bytes in entries if os.path.isfile(self._state_path(key)))
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        with open(index_path + '.part', 'w') as file:
+            json.dump([[list(key), n_bytes] for key, n_bytes in self.disk.items()], file)
+        os.replace(index_path + '.part', index_path)
+
+    def _read_disk(self, key):
+        with self._disk_lock:
+            if key not in self.disk:
+                raise KeyError("Key not found")
+            self.disk.move_to_end(key)
+            with np.load(self._state_path(key), allow_pickle=False) as saved:
+                return LlamaState(
+                    input_ids=saved['input_ids'],
+                    scores=saved['scores'],
+                    n_tokens=int(saved['n_tokens']),
+                    llama_state=saved['llama_state'].tobytes(),
+                    llama_state_size=int(saved['llama_state_size'])
+                    )
+
+    def _write_disk(self):
+        # states are written on this thread so saving never delays an answer
+        while True:
+            key, state = self._writes.get()
+            key = tuple(int(token) for token in key)
+            state_path = self._state_path(key)
+            with open(state_path + '.part', 'wb') as file:
+                np.savez(
+                    file,
+                    input_ids=state.input_ids,
+                    scores=state.scores,
+                    n_tokens=state.n_tokens,
+                    llama_state=np.frombuffer(state.llama_state, dtype=np.uint8),
+                    llama_state_size=state.llama_state_size
+                    )
+            os.replace(state_path + '.part', state_path)
+            with self._disk_lock:
+                self.disk.pop(key, None)
+                self.disk[key] = os.path.getsize(state_path)
+                while sum(self.disk.values()) > self.disk_bytes and len(self.disk) > 1:
+                    old_key, _ = self.disk.popitem(last=False)
+                    os.remove(self._state_path(old_key))
+                self._save_index()
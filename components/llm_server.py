@@ -1,6 +1,14 @@
+import os
+import threading
 from llama_cpp import Llama
 from huggingface_hub import hf_hub_download
+from .history import ChatHistory
+from .llm_cache import PrefixCache
 from .utils import remove_emojis
+from .utils import PipelineStage
+from .utils import SentenceSegmenter
+from .utils import remove_multiple_dots
+from .utils import MarkdownStream
 
 
 class Llm:
@@ -13,6 +21,10 @@ class Llm:
         self.streaming_output = self.params.get('streaming_output', None)
         self.chat_format = self.params.get('chat_format', None)
         self.system_message = self.params.get('system_message', None)
+        self.context = self.params.get('context', None) or {}
+        self.prompt_cache = self.params.get('prompt_cache', None) or {}
+        self.speculative_prefill = self.params.get('speculative_prefill', None)
+        self.segmenter = self.params.get('segmenter', None) or {}
         self.verbose = self.params.get('verbose', None)
        
         model_path = hf_hub_download(self.model_name, filename=self.model_file)
@@ -24,96 +36,105 @@ class Llm:
                     chat_format=self.chat_format,
                     verbose=self.verbose
                     )
+        self.lock = threading.Lock()
+        self.cache = None
+        if self.prompt_cache.get('enabled', None):
+            namespace = "{}-{}".format(os.path.splitext(self.model_file)[0], self.context_length)
+            self.cache = PrefixCache(self.llm, namespace, params=self.prompt_cache)
+            self.llm.set_cache(self.cache)
+            self.warm_up()
 
-        self.messages = [
-                {
-                    "role": "system", 
-                    "content": self.system_message
-                }
-            ]
+        self.messages = self.new_history()
 
-    def get_answer(self, nw, tts, data):
-        self.messages.append(
+    def new_history(self):
+        return ChatHistory(self.llm, self.lock, self.system_message, params=self.context)
+
+    def warm_up(self):
+        # evaluates the system prompt once so every conversation resumes from its cached state
+        with self.lock:
+            self.llm.create_chat_completion(
+                [
+                    {
+                        "role": "system",
+                        "content": self.system_message
+                    }
+                ],
+                max_tokens=1
+                )
+
+    def prefill(self, text, history=None):
+        # speculative: evaluates the partial user turn so get_answer only processes what changed since
+        if len(text) == 0 or not self.lock.acquire(blocking=False):
+            return
+        messages = (self.messages if history is None else history).messages() + [
+            {
+                "role": "user",
+                "content": text
+            }
+        ]
+        try:
+            self.llm.set_cache(None)
+            self.llm.create_chat_completion(messages, max_tokens=1)
+        finally:
+            self.llm.set_cache(self.cache)
+            self.lock.release()
+
+    def send_and_speak(self, nw, spans, segmenter, tts_stage, final=False):
+        sentences = []
+        for kind, text in spans:
+            nw.send_text(text, kind=kind)
+            # code is sent but never spoken, the prose before it is voiced right away
+            sentences += segmenter.flush() if kind == "code" else segmenter.feed(text)
+        if final:
+            sentences += segmenter.flush()
+        for sentence in sentences:
+            txt_for_tts = remove_emojis(remove_multiple_dots(sentence))
+            if len(txt_for_tts) > 1:
+                tts_stage.put(txt_for_tts)
+
+    def get_answer(self, nw, tts, data, history=None, voice=None, cancel=None):
+        messages = self.messages if history is None else history
+        messages.append(
             {
                 "role": "user", 
                 "content": data
             }
         )
     
-        outputs = self.llm.create_chat_completion(
-            self.messages,
-            stream=self.streaming_output
-            )
+        # sentences are voiced on their own thread while generation continues; the queue is
+        # unbounded here so waiting on tts never holds the generation lock other sessions need
+        with PipelineStage(lambda text: tts.run_tts(nw, text, voice=voice, cancel=cancel)) as tts_stage:
+            with self.lock:
+                outputs = self.llm.create_chat_completion(
+                    messages.messages(),
+                    stream=self.streaming_output
+                    )
         
-        if self.streaming_output:
-            llm_output = ""
-            tts_text_buffer = []
-            color_code_block = False
-            backticks = 0
-            skip_code_block_on_tts = False
-            nw.send_ack()
-            for i, out in enumerate(outputs):
-                if "content" in out['choices'][0]["delta"]:
-                    output_chunk_txt = out['choices'][0]["delta"]['content']
-                    if output_chunk_txt == "``" and backticks == 0:
-                        skip_code_block_on_tts = not skip_code_block_on_tts
-                        color_code_block = not color_code_block
-                        backticks += 2
-                    if backticks > 0 and backticks <= 3:
-                        backticks += 1
-                    else:
-                        backticks = 0
-                    if i == 1:
-                        if backticks == 0:
-                            nw.receive_ack()
-                            nw.send_msg("llm")
-                            nw.receive_ack()
-                            nw.send_msg(str(len(output_chunk_txt.strip().encode())))
-                            nw.receive_ack()
-                            nw.send_msg(output_chunk_txt.strip())
-                            nw.receive_ack()
-                            nw.send_msg(str(color_code_block))
+                if self.streaming_output:
+                    llm_output = ""
+                    markdown = MarkdownStream()
+                    segmenter = SentenceSegmenter(params=self.segmenter)
+                    for out in outputs:
+                        if cancel is not None and cancel.is_set():
+                            # llama.cpp stops at the next token, the part already said stays in the history
+                            break
+                        if "content" in out['choices'][0]["delta"]:
+                            output_chunk_txt = out['choices'][0]["delta"]['content']
+                            llm_output += output_chunk_txt
+                            self.send_and_speak(nw, markdown.feed(output_chunk_txt), segmenter, tts_stage)
                     else:
-                        if backticks == 0:
-                            nw.receive_ack()
-                            nw.send_msg("llm")
-                            nw.receive_ack()
-                            nw.send_msg(str(len(output_chunk_txt.encode())))
-                            nw.receive_ack()
-                            nw.send_msg(output_chunk_txt)
-                            nw.receive_ack()
-                            nw.send_msg(str(color_code_block))
-                    llm_output += output_chunk_txt
-                    if not skip_code_block_on_tts:
-                        tts_text_buffer.append(output_chunk_txt)
-                        if tts_text_buffer[-1] in [".", "!", "?", ":", "..", "..."]:
-                            # TODO handle float numbers
-                            # TODO remove multi dots
-                            # TODO handle emphasis
-                            txt_for_tts = remove_emojis("".join(tts_text_buffer).strip())
-                            if len(txt_for_tts) > 1:
-                                nw.receive_ack()
-                                nw.send_msg("tts")
-                                tts.run_tts(nw, txt_for_tts)
-                            tts_text_buffer = []
-            if not skip_code_block_on_tts and len(tts_text_buffer) != 0:
-                # TODO remove multi dots
-                txt_for_tts = remove_emojis("".join(tts_text_buffer).strip())
-                if len(txt_for_tts) > 1:
-                    nw.receive_ack()
-                    nw.send_msg("tts")
-                    tts.run_tts(nw, txt_for_tts)
-            nw.receive_ack()
-            nw.send_msg("streaming_end")
-            llm_output = llm_output.strip()
-        else:
-            llm_output = outputs["choices"][0]["message"]["content"].strip()
+                        self.send_and_speak(nw, markdown.flush(), segmenter, tts_stage, final=True)
+                    llm_output = llm_output.strip()
+                else:
+                    llm_output = outputs["choices"][0]["message"]["content"].strip()
 
-        self.messages.append(
+        messages.append(
             {
                 "role": "assistant", 
                 "content": llm_output
             }
         )
+        # the summary of dropped turns is generated only now, off the answer's critical path
+        messages.compact()
         
         return llm_output
\ No newline at end of file
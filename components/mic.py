@@ -1,5 +1,7 @@
+import queue
 import numpy as np
 import pyaudio
+from .utils import RingBuffer
 
 
 class Mic:
@@ -9,6 +11,7 @@ class Mic:
         self.samplerate = self.params.get('samplerate', None)
         self.buffer_size = self.params.get('buffer_size', None)
         self.channels = self.params.get('channels', None)
+        self.max_recording_sec = self.params.get('max_recording_sec', None)
         self.sample_format = pyaudio.paFloat32
         
         if self.audio_device == "default":
@@ -18,6 +21,9 @@ class Mic:
         self.update_ui = False
         self.vad_time = vad_params.get('no_voice_wait_sec', None)
         
+        self._recording_buffer = RingBuffer(int(self.max_recording_sec * self.samplerate * self.channels))
+        self._chunks = queue.Queue()
+        
         p = pyaudio.PyAudio()
         self._stream = p.open(
             format=self.sample_format,
@@ -29,34 +35,39 @@ class Mic:
             stream_callback=self._callback,
             start=False
         )
-        
-        # self._chunk_buffer = bytes()
-        self._recording_buffer = bytearray()
 
     def _callback(self, in_data, frame_count, time_info, status):
-        # self._chunk_buffer = in_data
-        # self._recording_buffer.extend(self._chunk_buffer)
-        self._recording_buffer.extend(in_data)
+        data = np.frombuffer(in_data, np.float32)
+        self._recording_buffer.write(data)
+        self._chunks.put(data)
         if self.update_ui:
-            self.ui.update_visual("You", np.frombuffer(in_data, np.float32).flatten(), time_color_warning=self.vad_time)
+            self.ui.update_visual("You", data, time_color_warning=self.vad_time)
         return (in_data, pyaudio.paContinue)
 
+    def _pending_samples(self):
+        # captured, but not yet handed out by get_chunk
+        return self._chunks.qsize() * self.buffer_size * self.channels
+
     def get_recording(self):
-        return np.frombuffer(self._recording_buffer, np.float32).flatten()
+        recording = self._recording_buffer.get()
+        return recording[:max(len(recording) - self._pending_samples(), 0)]
         
-    def get_chunk(self):
-        # return np.frombuffer(self._chunk_buffer, np.float32).flatten()
-        return np.frombuffer(self._recording_buffer[-(self.buffer_size*4):], np.float32).flatten()
+    def get_chunk(self, timeout=None):
+        try:
+            return self._chunks.get(timeout=timeout)
+        except queue.Empty:
+            return None
         
     def start_mic(self):
         self.update_ui = True
-        # self._chunk_buffer = bytes()
-        self._recording_buffer = bytearray()
+        self._recording_buffer.clear()
+        self._chunks = queue.Queue()
         self._stream.start_stream()
     
     def stop_mic(self):
         self._stream.stop_stream()
         self.update_ui = False
         
-    def reset_recording(self):
-        self._recording_buffer = bytearray()
+    def reset_recording(self, keep_sec=0):
+        keep = self._pending_samples() + int(keep_sec * self.samplerate) * self.channels
+        self._recording_buffer.clear(keep=keep)
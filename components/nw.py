@@ -1,4 +1,30 @@
+import asyncio
+import queue
 import socket
+import struct
+import threading
+from .codec import decode_audio
+from .codec import encode_audio
+
+
+FRAME_CONTROL = 0
+FRAME_TEXT = 1
+FRAME_AUDIO = 2
+FRAME_END = 3
+
+# first payload byte of a text frame, the index of its markdown span kind
+TEXT_KINDS = ["prose", "code", "emphasis"]
+
+# type byte + payload length, network byte order
+frame_header = struct.Struct('!BI')
+
+
+def pack_frame(frame_type, payload=b''):
+    return frame_header.pack(frame_type, len(payload)) + payload
+
+
+def decode_text(payload):
+    return payload[1:].decode(), TEXT_KINDS[payload[0]]
 
 
 class Nw:
@@ -8,47 +34,139 @@ class Nw:
         self.port = self.params.get('port', None)
         self.client_target_ip = self.params.get('client_target_ip', None)
         self.client_target_port = self.params.get('client_target_port', None)
+        self.audio_encodings = self.params.get('audio_encodings', None) or ['float32']
         self.con = None
-        
+        self.send_lock = threading.Lock()
+        self.audio_encoding = 'float32'
+
     def server_init(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host_ip, self.port))
         self.server_socket.listen(0)
-        
+
     def server_listening(self):
         print("Server listening...")
         self.con, client_address = self.server_socket.accept()
-        self.send_ack()
+        self.con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_control("ack")
         print("Client connected:", client_address)
         return client_address
-        
+
     def client_init(self):
         self.con = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
+
     def client_connect(self):
         self.con.connect((self.client_target_ip, self.client_target_port))
-        self.receive_ack()
-        
-    def send_ack(self):
-        self.con.sendall('ACK'.encode()) 
-
-    def send_msg(self, msg):
-        self.con.sendall(msg.encode())
-        
+        self.con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.receive_control() != "ack":
+            # a full server turns the connection away, the next attempt needs a fresh socket
+            self.con.close()
+            self.client_init()
+            raise ConnectionError("server busy")
+        self.negotiate_audio_encoding()
+
+    def send_frame(self, frame_type, payload=b''):
+        with self.send_lock:
+            self.con.sendall(pack_frame(frame_type, payload))
+
+    def send_control(self, msg):
+        self.send_frame(FRAME_CONTROL, msg.encode())
+
+    def send_text(self, text, kind="prose"):
+        self.send_frame(FRAME_TEXT, bytes([TEXT_KINDS.index(kind)]) + text.encode())
+
     def send_audio(self, data):
-        self.con.sendall(data)
-        
-    def receive_ack(self):
-        ack = self.con.recv(1024)
-        
-    def receive_msg(self, n_bytes=1024, waitall=False):
-        if waitall:
-            msg = self.con.recv(n_bytes, socket.MSG_WAITALL).decode()
-        else:
-            msg = self.con.recv(n_bytes).decode()
-        return msg
-    
-    def receive_audio(self, n_bytes):
-        data = self.con.recv(n_bytes, socket.MSG_WAITALL)
-        return data
-    
\ No newline at end of file
+        self.send_frame(FRAME_AUDIO, encode_audio(data, self.audio_encoding))
+
+    def send_end(self, stream):
+        self.send_frame(FRAME_END, stream.encode())
+
+    def _receive_exact(self, n_bytes):
+        data = bytearray(n_bytes)
+        view = memoryview(data)
+        received = 0
+        while received < n_bytes:
+            n_recv = self.con.recv_into(view[received:], n_bytes - received)
+            if n_recv == 0:
+                return None
+            received += n_recv
+        return bytes(data)
+
+    def receive_frame(self):
+        header = self._receive_exact(frame_header.size)
+        if header is None:
+            return None, None
+        frame_type, length = frame_header.unpack(header)
+        payload = self._receive_exact(length)
+        if payload is None:
+            return None, None
+        return frame_type, payload
+
+    def receive_control(self):
+        _, payload = self.receive_frame()
+        return payload.decode() if payload is not None else None
+
+    def receive_text(self):
+        _, payload = self.receive_frame()
+        return decode_text(payload)[0] if payload is not None else None
+
+    def receive_audio(self):
+        _, payload = self.receive_frame()
+        return self.decode_audio(payload) if payload is not None else None
+
+    def decode_audio(self, payload):
+        return decode_audio(payload, self.audio_encoding)
+
+    def negotiate_audio_encoding(self):
+        self.send_control("audio_encoding")
+        self.send_text(",".join(self.audio_encodings))
+        self.audio_encoding = self.receive_text()
+
+    def select_audio_encoding(self, offered):
+        self.audio_encoding = next(
+            (encoding for encoding in offered.split(",") if encoding in self.audio_encodings),
+            'float32'
+            )
+        self.send_text(self.audio_encoding)
+
+
+class AsyncNw(Nw):
+    def __init__(self, reader, writer, params=None):
+        super().__init__(params)
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.frames = queue.Queue()
+        self.con = writer.get_extra_info('socket')
+        self.con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def read_frames(self):
+        while True:
+            try:
+                header = await self.reader.readexactly(frame_header.size)
+                frame_type, length = frame_header.unpack(header)
+                payload = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.frames.put((None, None))
+                return
+            self.frames.put((frame_type, payload))
+
+    async def write_frame(self, frame_type, payload=b''):
+        self.writer.write(pack_frame(frame_type, payload))
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # read_frames sees the disconnect and ends the session
+            pass
+
+    def send_frame(self, frame_type, payload=b''):
+        # may be called from session and model worker threads, blocks while a slow client catches up
+        with self.send_lock:
+            asyncio.run_coroutine_threadsafe(self.write_frame(frame_type, payload), self.loop).result()
+
+    def receive_frame(self):
+        return self.frames.get()
+
+    def close(self):
+        # may be called from any thread, read_frames then sees the disconnect
+        self.loop.call_soon_threadsafe(self.writer.close)
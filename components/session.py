@@ -0,0 +1,285 @@
+import asyncio
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .nw import AsyncNw
+from .nw import FRAME_CONTROL
+from .stt import StreamingStt
+from .utils import remove_emojis
+from .utils import remove_multiple_dots
+from .utils import parse_markdown
+from .utils import LatestWorker
+
+
+class SttBatcher:
+    def __init__(self, stt, params=None):
+        params = params or {}
+        self._batch_wait_sec = params.get('batch_wait_ms', None) / 1000
+        self._max_batch = params.get('max_batch', None)
+        self._stt = stt
+        self._batch_methods = {
+            'transcribe_translate': stt.transcribe_batch,
+            'transcribe_segments': stt.transcribe_segments_batch,
+        }
+        self._requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def __getattr__(self, name):
+        if name in self._batch_methods:
+            def batched(data):
+                future = Future()
+                self._requests.put((name, data, future))
+                return future.result()
+            return batched
+        return getattr(self._stt, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super().__setattr__(name, value)
+        else:
+            setattr(self._stt, name, value)
+
+    def _collect(self):
+        # waits for the first request, then up to batch_wait_ms for others to join it
+        batch = [self._requests.get()]
+        deadline = time.monotonic() + self._batch_wait_sec
+        while len(batch) < self._max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            for name in dict.fromkeys(request[0] for request in batch):
+                requests = [request for request in batch if request[0] == name]
+                try:
+                    results = self._batch_methods[name]([request[1] for request in requests])
+                except Exception as e:
+                    for request in requests:
+                        request[2].set_exception(e)
+                    continue
+                for request, result in zip(requests, results):
+                    request[2].set_result(result)
+
+
+class Session:
+    def __init__(self, nw, vad, stt, llm, tts, mic_params=None):
+        self.nw = nw
+        self.vad = vad.new_session()
+        self.stt = stt
+        self.llm = llm
+        self.tts = tts
+        self.mic_params = mic_params or {}
+        self.buffer_size = self.mic_params.get('buffer_size', None)
+        self.samplerate = self.mic_params.get('samplerate', None)
+        self.history = llm.new_history()
+        self.utterance = []
+        self.stt_stream = None
+        self.prefill_worker = None
+        if stt.streaming.get('enabled', None):
+            on_partial = None
+            if llm.speculative_prefill:
+                self.prefill_worker = LatestWorker(lambda text: self.llm.prefill(text, history=self.history))
+                on_partial = self.prefill_worker.submit
+            self.stt_stream = StreamingStt(stt, params=stt.streaming, samplerate=self.samplerate, on_partial=on_partial)
+        self.preroll = deque(maxlen=int(self.vad.preroll_ms / 1000 * self.samplerate / self.buffer_size) + 1)
+        self.stt_data = None
+        self.voice = None
+        self.cancel = threading.Event()
+        self.answer_thread = None
+
+    def run(self):
+        try:
+            while True:
+                frame_type, payload = self.nw.receive_frame()
+                if frame_type is None:
+                    break
+                if frame_type == FRAME_CONTROL:
+                    self.handle(payload.decode())
+        except Exception:
+            # the client would otherwise wait forever for a reply, dropping it lets it reconnect
+            traceback.print_exc()
+            self.nw.close()
+        finally:
+            self.close()
+
+    def close(self):
+        self.cancel.set()
+        self.wait_answer()
+        if self.stt_stream is not None:
+            self.stt_stream.close()
+        if self.prefill_worker is not None:
+            self.prefill_worker.close()
+        if self.vad.pre_gate.enabled:
+            print("VAD inferences skipped by pre-gate:", self.vad.skipped_inferences, "of", self.vad.checked_chunks)
+        if self.llm.cache is not None:
+            cache = self.llm.cache
+            print("LLM prefix cache hits:", cache.hits, "of", cache.lookups, "reused prompt tokens:", cache.reused_tokens, "dropped disk writes:", cache.dropped_writes)
+
+    def handle(self, client_data):
+        nw = self.nw
+        if client_data == 'audio_encoding':
+            nw.select_audio_encoding(nw.receive_text())
+        elif client_data == 'voice':
+            self.voice = nw.receive_text()
+        elif client_data == 'reset_vad':
+            self.vad.reset_vad()
+            self.reset_utterance()
+            self.preroll.clear()
+        elif client_data == 'vad_check':
+            mic_chunk = nw.receive_audio()
+            vad_time = self.vad.no_voice_wait_sec - self.vad.no_voice_sec
+            chunk_time = self.buffer_size / self.samplerate
+            vad_status = self.vad.check(mic_chunk, chunk_time)
+            nw.send_control(str(vad_status))
+            nw.send_text(str(vad_time))
+            if vad_status is None:
+                self.reset_utterance()
+                self.preroll.append(mic_chunk)
+            else:
+                if len(self.utterance) == 0:
+                    self.add_to_utterance(list(self.preroll))
+                    self.preroll.clear()
+                self.add_to_utterance([mic_chunk])
+                if vad_status == "vad_end":
+                    self.transcribe_utterance()
+        elif client_data == 'utterance_chunk':
+            self.add_to_utterance([nw.receive_audio()])
+        elif client_data == 'utterance_reset':
+            self.reset_utterance()
+        elif client_data == 'utterance_end':
+            self.transcribe_utterance()
+        elif client_data == 'llm_get_answer':
+            self.start_answer(self.llm_answer)
+        elif client_data == 'fixed_answer':
+            self.start_answer(self.fixed_answer)
+        elif client_data == 'cancel':
+            self.cancel.set()
+
+    def start_answer(self, answer):
+        # answers run beside the frame loop so a barge-in from the client is seen while Aria speaks
+        self.wait_answer()
+        self.cancel = threading.Event()
+        self.answer_thread = threading.Thread(target=self.run_answer, args=(answer, self.cancel), daemon=True)
+        self.answer_thread.start()
+
+    def run_answer(self, answer, cancel):
+        try:
+            answer(cancel)
+        except Exception:
+            # without its end frame the client would wait for this answer forever
+            traceback.print_exc()
+            self.nw.close()
+
+    def wait_answer(self):
+        if self.answer_thread is not None:
+            self.answer_thread.join()
+            self.answer_thread = None
+
+    def llm_answer(self, cancel):
+        nw = self.nw
+        llm_data = self.llm.get_answer(nw, self.tts, self.stt_data, history=self.history, voice=self.voice, cancel=cancel)
+        if not self.llm.streaming_output and not cancel.is_set():
+            spans = parse_markdown(llm_data)
+            for kind, text in spans:
+                nw.send_text(text, kind=kind)
+            self.tts.text_splitting = True
+            txt_for_tts = remove_emojis(remove_multiple_dots("".join(text for kind, text in spans if kind != "code")))
+            self.tts.run_tts(nw, txt_for_tts, voice=self.voice, cancel=cancel)
+        nw.send_end("llm")
+
+    def fixed_answer(self, cancel):
+        self.tts.run_tts(self.nw, "Did you say something?", voice=self.voice, cancel=cancel)
+        self.nw.send_end("tts")
+
+    def add_to_utterance(self, chunks):
+        self.utterance.extend(chunks)
+        if self.stt_stream is not None:
+            for chunk in chunks:
+                self.stt_stream.feed(chunk)
+
+    def reset_utterance(self):
+        if len(self.utterance) > 0:
+            self.utterance = []
+            if self.stt_stream is not None:
+                self.stt_stream.reset()
+
+    def transcribe_utterance(self):
+        # an interrupted answer ends its frames before the new transcript is sent
+        self.wait_answer()
+        if self.stt_stream is not None:
+            self.utterance = []
+            self.stt_data = self.stt_stream.finish(trim_sec=self.vad.no_voice_wait_sec, preprocess=self.vad.trim_for_stt)
+        else:
+            mic_recording = np.concatenate(self.utterance) if self.utterance else np.zeros(0, np.float32)
+            self.utterance = []
+            mic_recording = mic_recording[:-int(self.vad.no_voice_wait_sec*self.samplerate)]
+            mic_recording = self.vad.trim_for_stt(mic_recording)
+            # wf.write('test.wav', self.samplerate, mic_recording)
+            self.stt_data = self.stt.transcribe_translate(mic_recording)
+        self.nw.send_text(self.stt_data)
+
+
+class SessionServer:
+    def __init__(self, vad, stt, llm, tts, params=None, mic_params=None):
+        self.params = params or {}
+        self.host_ip = self.params.get('host_ip', None)
+        self.port = self.params.get('port', None)
+        self.max_sessions = self.params.get('max_sessions', None)
+        self.mic_params = mic_params or {}
+
+        self.vad = vad
+        # stt requests from all sessions are batched into shared forward passes
+        self.stt = SttBatcher(stt, params=stt.batching)
+        # the llm is not queued: its own lock serializes generation, and only for as long as
+        # tokens are produced, so one session's tts and playback never hold up another's answer
+        self.llm = llm
+        # tts runs its gpu steps on a single worker of its own, the sends stay with each session
+        self.tts = tts
+        self.executor = ThreadPoolExecutor(max_workers=self.max_sessions)
+        self.active_sessions = 0
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        nw = AsyncNw(reader, writer, params=self.params)
+        if self.active_sessions >= self.max_sessions:
+            # a session without a free executor worker would never be served, the client retries
+            await nw.write_frame(FRAME_CONTROL, "busy".encode())
+            print("Client rejected, server full:", client_address)
+        else:
+            self.active_sessions += 1
+            try:
+                await nw.write_frame(FRAME_CONTROL, "ack".encode())
+                print("Client connected:", client_address)
+                session = Session(nw, self.vad, self.stt, self.llm, self.tts, self.mic_params)
+                session_task = asyncio.get_running_loop().run_in_executor(self.executor, session.run)
+                await nw.read_frames()
+                await session_task
+            finally:
+                self.active_sessions -= 1
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        print("Client disconnected:", client_address)
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.host_ip, self.port)
+        print("Server listening...")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
@@ -0,0 +1,148 @@
+import os
+import urllib.request
+import numpy as np
+import onnxruntime as ort
+
+
+def download_model(model_url, cache_dir):
+    cache_dir = os.path.expanduser(cache_dir)
+    model_path = os.path.join(cache_dir, os.path.basename(model_url))
+    if not os.path.isfile(model_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        urllib.request.urlretrieve(model_url, model_path + '.part')
+        os.replace(model_path + '.part', model_path)
+    return model_path
+
+
+class SileroOnnx:
+    def __init__(self, model_path, num_threads=1):
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = num_threads
+        opts.inter_op_num_threads = 1
+        opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, sess_options=opts, providers=['CPUExecutionProvider'])
+        # v5 models carry a single state tensor and need the previous chunk's tail as context
+        self.v5 = 'state' in [model_input.name for model_input in self.session.get_inputs()]
+        self.reset_states()
+
+    def reset_states(self):
+        if self.v5:
+            self._state = np.zeros((2, 1, 128), dtype=np.float32)
+        else:
+            self._h = np.zeros((2, 1, 64), dtype=np.float32)
+            self._c = np.zeros((2, 1, 64), dtype=np.float32)
+        self._context = None
+
+    def __call__(self, x, sr):
+        x = np.asarray(x, dtype=np.float32).reshape(1, -1)
+        sr = np.array(sr, dtype=np.int64)
+        if self.v5:
+            context_size = 64 if sr == 16000 else 32
+            if self._context is None:
+                self._context = np.zeros((1, context_size), dtype=np.float32)
+            x = np.concatenate((self._context, x), axis=1)
+            out, self._state = self.session.run(None, {'input': x, 'state': self._state, 'sr': sr})
+            self._context = x[:, -context_size:]
+        else:
+            out, self._h, self._c = self.session.run(None, {'input': x, 'h': self._h, 'c': self._c, 'sr': sr})
+        return float(out[0][0])
+
+
+class VADIterator:
+    def __init__(self, model, threshold=0.5, sampling_rate=16000, min_silence_duration_ms=100, speech_pad_ms=30):
+        self.model = model
+        self.threshold = threshold
+        self.sampling_rate = sampling_rate
+        self.min_silence_samples = sampling_rate * min_silence_duration_ms / 1000
+        self.speech_pad_samples = sampling_rate * speech_pad_ms / 1000
+        self.reset_states()
+
+    def reset_states(self):
+        self.model.reset_states()
+        self.triggered = False
+        self.temp_end = 0
+        self.current_sample = 0
+
+    def __call__(self, x, return_seconds=False):
+        window_size_samples = len(x)
+        self.current_sample += window_size_samples
+        speech_prob = self.model(x, self.sampling_rate)
+
+        if speech_prob >= self.threshold and self.temp_end:
+            self.temp_end = 0
+
+        if speech_prob >= self.threshold and not self.triggered:
+            self.triggered = True
+            speech_start = self.current_sample - self.speech_pad_samples - window_size_samples
+            return {'start': int(speech_start) if not return_seconds else round(speech_start / self.sampling_rate, 1)}
+
+        if speech_prob < self.threshold - 0.15 and self.triggered:
+            if not self.temp_end:
+                self.temp_end = self.current_sample
+            if self.current_sample - self.temp_end < self.min_silence_samples:
+                return None
+            speech_end = self.temp_end + self.speech_pad_samples - window_size_samples
+            self.temp_end = 0
+            self.triggered = False
+            return {'end': int(speech_end) if not return_seconds else round(speech_end / self.sampling_rate, 1)}
+
+        return None
+
+
+def get_speech_timestamps(audio, model, threshold=0.5, sampling_rate=16000, min_speech_duration_ms=250,
+                          min_silence_duration_ms=100, window_size_samples=512, speech_pad_ms=30):
+    model.reset_states()
+    min_speech_samples = sampling_rate * min_speech_duration_ms / 1000
+    min_silence_samples = sampling_rate * min_silence_duration_ms / 1000
+    speech_pad_samples = sampling_rate * speech_pad_ms / 1000
+    audio_length_samples = len(audio)
+
+    speech_probs = []
+    for current_start_sample in range(0, audio_length_samples, window_size_samples):
+        chunk = audio[current_start_sample:current_start_sample + window_size_samples]
+        if len(chunk) < window_size_samples:
+            chunk = np.pad(chunk, (0, window_size_samples - len(chunk)))
+        speech_probs.append(model(chunk, sampling_rate))
+
+    triggered = False
+    speeches = []
+    current_speech = {}
+    temp_end = 0
+    for i, speech_prob in enumerate(speech_probs):
+        if speech_prob >= threshold and temp_end:
+            temp_end = 0
+        if speech_prob >= threshold and not triggered:
+            triggered = True
+            current_speech['start'] = window_size_samples * i
+            continue
+        if speech_prob < threshold - 0.15 and triggered:
+            if not temp_end:
+                temp_end = window_size_samples * i
+            if window_size_samples * i - temp_end < min_silence_samples:
+                continue
+            current_speech['end'] = temp_end
+            if current_speech['end'] - current_speech['start'] > min_speech_samples:
+                speeches.append(current_speech)
+            current_speech = {}
+            temp_end = 0
+            triggered = False
+    if current_speech and audio_length_samples - current_speech['start'] > min_speech_samples:
+        current_speech['end'] = audio_length_samples
+        speeches.append(current_speech)
+
+    for i, speech in enumerate(speeches):
+        if i == 0:
+            speech['start'] = int(max(0, speech['start'] - speech_pad_samples))
+        if i != len(speeches) - 1:
+            silence_duration = speeches[i + 1]['start'] - speech['end']
+            if silence_duration < 2 * speech_pad_samples:
+                speech['end'] += int(silence_duration // 2)
+                speeches[i + 1]['start'] = int(max(0, speeches[i + 1]['start'] - silence_duration // 2))
+            else:
+                speech['end'] = int(min(audio_length_samples, speech['end'] + speech_pad_samples))
+                speeches[i + 1]['start'] = int(max(0, speeches[i + 1]['start'] - speech_pad_samples))
+        else:
+            speech['end'] = int(min(audio_length_samples, speech['end'] + speech_pad_samples))
+
+    return speeches
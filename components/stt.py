@@ -1,7 +1,11 @@
+import os
+import threading
 import warnings
+import numpy as np
 import torch
 import transformers
-from transformers import AutoModelForSpeechSeq2Seq, AutoProcessor, pipeline
+from transformers import AutoConfig, AutoModelForSpeechSeq2Seq, AutoProcessor, GenerationConfig, pipeline
+from transformers.modeling_utils import no_init_weights
 
 
 class Stt:
@@ -11,6 +15,11 @@ class Stt:
         self.model_name = self.params.get('model_name', None)
         self.low_cpu_mem_usage = self.params.get('low_cpu_mem_usage', None)
         self.attn = self.params.get('attn', None)
+        self.short_max_sec = self.params.get('short_max_sec', None)
+        self.max_new_tokens = self.params.get('max_new_tokens', None)
+        self.streaming = self.params.get('streaming', None) or {}
+        self.cpu_profile = self.params.get('cpu_profile', None) or {}
+        self.batching = self.params.get('batching', None) or {}
         self.verbose = self.params.get('verbose', None)
         
         if not self.verbose:
@@ -19,35 +28,232 @@ class Stt:
         
         if self.device == "cpu":
             self.attn = "sdpa"
+            if self.cpu_profile.get('model_name', None):
+                self.model_name = self.cpu_profile.get('model_name', None)
+            if self.cpu_profile.get('num_threads', None):
+                torch.set_num_threads(self.cpu_profile.get('num_threads', None))
             
-        torch_dtype = torch.float16 if torch.cuda.is_available() and "cuda" in self.device else torch.float32
+        self.torch_dtype = torch.float16 if torch.cuda.is_available() and "cuda" in self.device else torch.float32
         
-        model = AutoModelForSpeechSeq2Seq.from_pretrained(
-            self.model_name,
-            torch_dtype=torch_dtype,
-            low_cpu_mem_usage=self.low_cpu_mem_usage,
-            use_safetensors=True,
-            attn_implementation=self.attn,
-            device_map=self.device
-        )
+        if self.device == "cpu" and self.cpu_profile.get('quantize', None):
+            self.model = self._load_quantized()
+        else:
+            self.model = self._load_model()
         
-        processor = AutoProcessor.from_pretrained(self.model_name)
+        self.processor = AutoProcessor.from_pretrained(self.model_name)
+        self.samplerate = self.processor.feature_extractor.sampling_rate
         self.pipe = pipeline(
             "automatic-speech-recognition",
-            model=model,
-            tokenizer=processor.tokenizer,
-            feature_extractor=processor.feature_extractor,
-            max_new_tokens=128,
+            model=self.model,
+            tokenizer=self.processor.tokenizer,
+            feature_extractor=self.processor.feature_extractor,
+            max_new_tokens=self.max_new_tokens,
             chunk_length_s=30,
             batch_size=16,
             return_timestamps=True,
-            torch_dtype=torch_dtype
+            torch_dtype=self.torch_dtype
+        )
+
+    def _load_model(self):
+        return AutoModelForSpeechSeq2Seq.from_pretrained(
+            self.model_name,
+            torch_dtype=self.torch_dtype,
+            low_cpu_mem_usage=self.low_cpu_mem_usage,
+            use_safetensors=True,
+            attn_implementation=self.attn,
+            device_map=self.device
+        )
+
+    def _load_quantized(self):
+        # int8 dynamic quantization of the linear layers, cached so it only runs once
+        cache_dir = os.path.expanduser(self.cpu_profile.get('cache_dir', None))
+        cache_file = "{}-int8-torch{}-transformers{}.state_dict.pt".format(
+            self.model_name.replace('/', '--'),
+            torch.__version__,
+            transformers.__version__
         )
+        cache_path = os.path.join(cache_dir, cache_file)
+        if os.path.isfile(cache_path):
+            # the module is rebuilt from its config, only tensors are read from the cache file,
+            # and the random init is skipped since every weight is overwritten by the state_dict
+            with no_init_weights():
+                model = AutoModelForSpeechSeq2Seq.from_config(
+                    AutoConfig.from_pretrained(self.model_name),
+                    torch_dtype=self.torch_dtype,
+                    attn_implementation=self.attn
+                )
+            model.generation_config = GenerationConfig.from_pretrained(self.model_name)
+            model = self._quantize(model)
+            model.load_state_dict(torch.load(cache_path, weights_only=True))
+            return model
+        model = self._quantize(self._load_model())
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(model.state_dict(), cache_path + '.part')
+        os.replace(cache_path + '.part', cache_path)
+        return model
+
+    def _quantize(self, model):
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8).eval()
 
     def transcribe_translate(self, data):
+        if len(data) <= self.short_max_sec * self.samplerate:
+            return self.transcribe_short(data)
+        return self.transcribe_long(data)
+
+    def transcribe_short(self, data):
+        return self._generate([data])[0]
+
+    def _generate(self, batch):
+        # one padded 30 s window per clip, greedy decoding, no timestamp tokens
+        input_features = self.processor.feature_extractor(
+            batch,
+            sampling_rate=self.samplerate,
+            return_tensors="pt"
+        ).input_features.to(self.model.device, dtype=self.torch_dtype)
+        with torch.inference_mode():
+            tokens = self.model.generate(
+                input_features,
+                language="en",
+                num_beams=1,
+                do_sample=False,
+                return_timestamps=False,
+                max_new_tokens=self.max_new_tokens
+            )
+        return [text.strip() for text in self.processor.tokenizer.batch_decode(tokens, skip_special_tokens=True)]
+
+    def transcribe_long(self, data):
+        data = self.pipe(
+            data,
+            generate_kwargs={"language": "en"}
+        )
+        return data["text"].strip()
+
+    def transcribe_segments(self, data):
         data = self.pipe(
             data,
             generate_kwargs={"language": "en"}
         )
-        data = data["text"][1:]
-        return data
\ No newline at end of file
+        return [(chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"]) for chunk in data["chunks"]]
+
+    def transcribe_batch(self, batch):
+        # short clips share one padded generate call, long ones go through the chunked pipeline
+        texts = [None] * len(batch)
+        short = [i for i, data in enumerate(batch) if len(data) <= self.short_max_sec * self.samplerate]
+        if short:
+            for i, text in zip(short, self._generate([batch[i] for i in short])):
+                texts[i] = text
+        for i, data in enumerate(batch):
+            if texts[i] is None:
+                texts[i] = self.transcribe_long(data)
+        return texts
+
+    def transcribe_segments_batch(self, batch):
+        results = self.pipe(
+            list(batch),
+            generate_kwargs={"language": "en"}
+        )
+        return [
+            [(chunk["timestamp"][0], chunk["timestamp"][1], chunk["text"]) for chunk in data["chunks"]]
+            for data in results
+            ]
+
+
+class StreamingStt:
+    def __init__(self, stt, params=None, samplerate=None, on_partial=None):
+        self.params = params or {}
+        self.step_sec = self.params.get('step_sec', None)
+        self.unstable_tail_sec = self.params.get('unstable_tail_sec', None)
+        self.stt = stt
+        self.samplerate = samplerate
+        self.on_partial = on_partial
+
+        self._lock = threading.Lock()
+        self._decode_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.reset()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+
+    def reset(self):
+        with self._lock:
+            self._chunks = []
+            self._n_samples = 0
+            self._decoded_samples = 0
+            self._offset = 0
+            self._committed = []
+            self._previous = []
+            self._generation = getattr(self, '_generation', 0) + 1
+
+    def is_empty(self):
+        return self._n_samples == 0
+
+    def feed(self, data):
+        with self._lock:
+            self._chunks.append(np.array(data, dtype=np.float32))
+            self._n_samples += len(data)
+            if self._n_samples - self._decoded_samples >= self.step_sec * self.samplerate:
+                self._wakeup.set()
+
+    def _window(self, end=None):
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(self._chunks)]
+        audio = self._chunks[0] if self._chunks else np.zeros(0, np.float32)
+        return audio[self._offset:end]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            with self._decode_lock:
+                with self._lock:
+                    generation = self._generation
+                    self._decoded_samples = self._n_samples
+                    window = self._window()
+                # a wakeup left over from before finish() or reset() finds nothing to decode
+                if len(window) == 0:
+                    continue
+                try:
+                    segments = self.stt.transcribe_segments(window)
+                except Exception as e:
+                    # partials are best effort, finish() still decodes the utterance
+                    print("Streaming stt decode failed:", repr(e))
+                    continue
+                with self._lock:
+                    if generation != self._generation:
+                        continue
+                    self._commit(segments, len(window) / self.samplerate)
+                    partial = "".join(self._committed + [segment[2] for segment in self._previous]).strip()
+            if self.on_partial is not None:
+                self.on_partial(partial)
+
+    def _commit(self, segments, window_sec):
+        # a segment is stable once two consecutive decodes agree on it and it ends well before the window end
+        stable_sec = window_sec - self.unstable_tail_sec
+        n_stable = 0
+        for segment, previous in zip(segments, self._previous):
+            if segment[1] is None or segment[1] > stable_sec or segment[2] != previous[2]:
+                break
+            n_stable += 1
+        if n_stable > 0:
+            self._committed.extend(segment[2] for segment in segments[:n_stable])
+            self._offset += int(segments[n_stable - 1][1] * self.samplerate)
+        self._previous = segments[n_stable:]
+
+    def finish(self, trim_sec=0, preprocess=None):
+        # waits for an in-flight decode, then re-decodes only the uncommitted tail
+        with self._decode_lock:
+            with self._lock:
+                tail = self._window(max(self._n_samples - int(trim_sec * self.samplerate), self._offset))
+                committed = self._committed
+            if preprocess is not None:
+                tail = preprocess(tail)
+            if len(tail) > 0:
+                committed = committed + [segment[2] for segment in self.stt.transcribe_segments(tail)]
+            self.reset()
+        return "".join(committed).strip()
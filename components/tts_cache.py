@@ -0,0 +1,110 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from .codec import decode_audio
+from .codec import encode_audio
+
+
+class LatentCache:
+    def __init__(self, model, model_version, params=None):
+        self.params = params or {}
+        self.max_voices = self.params.get('max_voices', None)
+        self.cache_dir = os.path.expanduser(self.params.get('cache_dir', None))
+        self.model = model
+        self.model_version = model_version
+        self.latents = OrderedDict()
+        self.voice_hashes = {}
+
+    def voice_key(self, voice_path):
+        # the file is only hashed again when it changes on disk
+        stat = os.stat(voice_path)
+        voice_hash = self.voice_hashes.get(voice_path)
+        if voice_hash is None or voice_hash[0] != (stat.st_size, stat.st_mtime_ns):
+            with open(voice_path, 'rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            voice_hash = ((stat.st_size, stat.st_mtime_ns), digest)
+            self.voice_hashes[voice_path] = voice_hash
+        return hashlib.sha256((self.model_version + voice_hash[1]).encode()).hexdigest()
+
+    def get(self, voice_path):
+        key = self.voice_key(voice_path)
+        if key in self.latents:
+            self.latents.move_to_end(key)
+            return self.latents[key]
+        cache_path = os.path.join(self.cache_dir, key + '.pt')
+        if os.path.isfile(cache_path):
+            saved = torch.load(cache_path, map_location=next(self.model.parameters()).device, weights_only=True)
+            latents = (saved['gpt_cond_latent'], saved['speaker_embedding'])
+        else:
+            latents = self.model.get_conditioning_latents(audio_path=[voice_path])
+            os.makedirs(self.cache_dir, exist_ok=True)
+            torch.save(
+                {
+                    'gpt_cond_latent': latents[0].cpu(),
+                    'speaker_embedding': latents[1].cpu()
+                },
+                cache_path + '.part'
+                )
+            os.replace(cache_path + '.part', cache_path)
+        self.latents[key] = latents
+        while len(self.latents) > self.max_voices:
+            self.latents.popitem(last=False)
+        return latents
+
+
+class AudioCache:
+    def __init__(self, samplerate, params=None):
+        self.params = params or {}
+        self.max_bytes = int(self.params.get('max_mb', None) * 2**20)
+        self.max_chars = self.params.get('max_chars', None)
+        self.cache_dir = self.params.get('cache_dir', None)
+        self.prewarm = self.params.get('prewarm', None) or []
+        if self.cache_dir:
+            self.cache_dir = os.path.expanduser(self.cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self.samplerate = samplerate
+        self.audio = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def key(self, text, voice_key):
+        # voice_key already covers the voice file contents and the model version
+        text = " ".join(text.split())
+        return hashlib.sha256("{}|{}|{}".format(voice_key, self.samplerate, text).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.audio:
+                self.audio.move_to_end(key)
+                return self.audio[key]
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, key + '.bin')
+            if os.path.isfile(cache_path):
+                with open(cache_path, 'rb') as file:
+                    audio = decode_audio(file.read(), 'int16_zlib')
+                self._put_memory(key, audio)
+                return audio
+        return None
+
+    def put(self, key, text, chunks):
+        if len(text) > self.max_chars or len(chunks) == 0:
+            return
+        audio = np.concatenate(chunks).astype(np.float32)
+        self._put_memory(key, audio)
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, key + '.bin')
+            with open(cache_path + '.part', 'wb') as file:
+                file.write(encode_audio(audio, 'int16_zlib'))
+            os.replace(cache_path + '.part', cache_path)
+
+    def _put_memory(self, key, audio):
+        with self.lock:
+            if key in self.audio:
+                self.n_bytes -= self.audio.pop(key).nbytes
+            self.audio[key] = audio
+            self.n_bytes += audio.nbytes
+            while self.n_bytes > self.max_bytes and len(self.audio) > 1:
+                self.n_bytes -= self.audio.popitem(last=False)[1].nbytes
@@ -1,9 +1,12 @@
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from TTS.utils.generic_utils import get_user_data_dir
 from TTS.utils.manage import ModelManager
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
+from .tts_cache import AudioCache
+from .tts_cache import LatentCache
 
 
 class Tts:
@@ -16,6 +19,13 @@ class Tts:
         self.force_reload = self.params.get('force_reload', None)
         self.verbose = self.params.get('verbose', None)
         self.voice_to_clone = self.params.get('assets', None).get('voice_to_clone', None)
+        self.voice = self.params.get('voice', None)
+        self.voices = self.params.get('voices', None) or {}
+        self.latent_cache = self.params.get('latent_cache', None) or {}
+        self.audio_cache = self.params.get('audio_cache', None) or {}
+
+        # synthesis steps from all sessions share one worker, in arrival order
+        self._worker = ThreadPoolExecutor(max_workers=1)
         
         if not self.verbose:
             warnings.filterwarnings("ignore", module="TTS")
@@ -34,27 +44,54 @@ class Tts:
         if self.device == 'gpu':
             self.model.cuda()
 
-        self.gpt_cond_latent, self.speaker_embedding = self.model.get_conditioning_latents(
-                audio_path=[self.voice_to_clone]
-            )
+        checkpoint = os.stat(os.path.join(self.model_path, 'model.pth'))
+        model_version = "{}-{}-{}".format(self.model_name, checkpoint.st_size, checkpoint.st_mtime_ns)
+        self.latents = LatentCache(self.model, model_version, params=self.latent_cache)
+        self.default_voice = self.voices.get(self.voice, self.voice_to_clone)
+        self.gpt_cond_latent, self.speaker_embedding = self.latents.get(self.default_voice)
+        self.audio = AudioCache(self.config.audio.output_sample_rate, params=self.audio_cache)
+        for phrase in self.audio.prewarm:
+            for _ in self.synthesize(phrase):
+                pass
     
-    def run_tts(self, nw, data):
+    def synthesize(self, data, voice_path=None, cancel=None):
+        # yields numpy audio chunks, a cached phrase comes back as one chunk
+        if cancel is not None and cancel.is_set():
+            return
+        voice_path = voice_path or self.default_voice
+        audio_key = self.audio.key(data, self.latents.voice_key(voice_path))
+        audio = self.audio.get(audio_key)
+        if audio is not None:
+            yield audio
+            return
+        gpt_cond_latent, speaker_embedding = self.latents.get(voice_path)
+        tts_stream = self.model.inference_stream(
+                data,
+                "en",
+                gpt_cond_latent,
+                speaker_embedding,
+                enable_text_splitting=self.text_splitting
+            )
+        chunks = []
+        for chunk in tts_stream:
+            # returning closes the xtts stream, so a barge-in stops synthesis within one chunk
+            if cancel is not None and cancel.is_set():
+                return
+            chunk = chunk.squeeze()
+            if self.device == 'gpu':
+                chunk = chunk.cpu()
+            chunks.append(chunk.numpy())
+            yield chunks[-1]
+        self.audio.put(audio_key, data, chunks)
+
+    def run_tts(self, nw, data, voice=None, cancel=None):
         if not all(char.isspace() for char in data):
-            tts_stream = self.model.inference_stream(
-                    data,
-                    "en",
-                    self.gpt_cond_latent,
-                    self.speaker_embedding,
-                    enable_text_splitting=self.text_splitting
-                )
-            for chunk in tts_stream:
-                chunk = chunk.squeeze()
-                if self.device == 'gpu':
-                    chunk = chunk.cpu()
-                nw.receive_ack()
-                nw.send_msg(str(len(chunk.numpy().tobytes())))
-                nw.receive_ack()
-                nw.send_audio(chunk.numpy().tobytes())
-        nw.receive_ack()
-        nw.send_msg("tts_end")
-        return 'tts_done'  
+            chunks = self.synthesize(data, self.voices.get(voice, self.default_voice), cancel=cancel)
+            while True:
+                # only the gpu step runs on the shared worker, the send stays on the calling
+                # session's thread so a slow client holds up nobody but itself
+                chunk = self._worker.submit(next, chunks, None).result()
+                if chunk is None:
+                    break
+                nw.send_audio(chunk)
+        return 'tts_done'
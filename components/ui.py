@@ -1,4 +1,5 @@
 import tkinter as tk
+import tkinter.font as tkfont
 import numpy as np
 import scipy.fft
 from PIL import Image, ImageTk, ImageSequence
@@ -83,6 +84,10 @@ class Ui:
         self.text_widget.tag_configure("user_name_Aria", foreground=aria_color, font=("Arial", 12, "bold"))
         self.text_widget.tag_configure("normal_text", foreground="white")
         self.text_widget.tag_configure("code", foreground=code_color)
+        emphasis_font = tkfont.Font(font=self.text_widget.cget("font"))
+        emphasis_font.configure(slant="italic")
+        self.text_widget.tag_configure("emphasis", foreground="white", font=emphasis_font)
+        self.text_tags = {"prose": "normal_text", "code": "code", "emphasis": "emphasis"}
         
         self.root.bind("<Configure>", self.on_resize)
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -204,23 +209,12 @@ class Ui:
             self.text_widget.clipboard_clear()
             self.text_widget.clipboard_append(selected_text)
 
-    def add_message(self, user_name, text, new_entry=False, color_code_block=False, code_blocks=[]):
+    def add_message(self, user_name, text, new_entry=False, kind="prose"):
         try:
             self.text_widget.config(state="normal")
             if new_entry:
                 self.text_widget.insert("end", '\n\n' + user_name + ": ", "user_name_" + user_name)
-            if color_code_block:
-                if len(code_blocks) > 0:
-                    current_pos = 0
-                    for block_start, block_end in code_blocks:
-                        self.text_widget.insert("end", text[current_pos:block_start], "normal_text")
-                        self.text_widget.insert("end", text[block_start + 3:block_end - 2], "code")
-                        current_pos = block_end + 1 
-                    self.text_widget.insert("end", text[current_pos:], "normal_text")  
-                else:    
-                    self.text_widget.insert("end", text, "code")
-            else:
-                self.text_widget.insert("end", text, "normal_text")
+            self.text_widget.insert("end", text, self.text_tags[kind])
             self.text_widget.config(state="disabled")
             self.text_widget.update()
             self.text_widget.see("end")
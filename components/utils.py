@@ -1,4 +1,7 @@
 import re
+import queue
+import threading
+import numpy as np
 
 
 def remove_emojis(text):
@@ -23,14 +26,323 @@ def remove_multiple_dots(text):
     return result_str
 
 
-def remove_code_blocks(text):
-    pattern = r'```.*?```'
-    return re.sub(pattern, '', text, flags=re.DOTALL)
+def parse_markdown(text):
+    markdown = MarkdownStream()
+    return markdown.feed(text) + markdown.flush()
 
 
-def find_code_blocks(text):
-    code_blocks = []
-    pattern = r'```.*?```'
-    for match in re.finditer(pattern, text, flags=re.DOTALL):
-        code_blocks.append([match.start(), match.end() - 1])
-    return code_blocks
+class RingBuffer:
+    def __init__(self, capacity, dtype=np.float32):
+        self.capacity = capacity
+        # every sample is written twice, so the latest n samples are always contiguous
+        self._buffer = np.zeros(2 * capacity, dtype=dtype)
+        self._write_pos = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def write(self, data):
+        if len(data) > self.capacity:
+            data = data[-self.capacity:]
+        n_samples = len(data)
+        with self._lock:
+            start = self._write_pos
+            first = min(n_samples, self.capacity - start)
+            self._buffer[start:start + first] = data[:first]
+            self._buffer[start + self.capacity:start + self.capacity + first] = data[:first]
+            rest = n_samples - first
+            if rest > 0:
+                self._buffer[:rest] = data[first:]
+                self._buffer[self.capacity:self.capacity + rest] = data[first:]
+            self._write_pos = (start + n_samples) % self.capacity
+            self._count = min(self._count + n_samples, self.capacity)
+
+    def latest(self, n_samples):
+        # zero-copy view, valid until capacity - n_samples more samples are written
+        with self._lock:
+            n_samples = min(n_samples, self._count)
+            end = self._write_pos + self.capacity
+            return self._buffer[end - n_samples:end]
+
+    def get(self):
+        return self.latest(self.capacity)
+
+    def clear(self, keep=0):
+        with self._lock:
+            self._count = min(keep, self._count)
+
+
+class LatestWorker:
+    def __init__(self, fn):
+        self.fn = fn
+        self._args = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def close(self):
+        # a call already running finishes, a pending one is dropped
+        self._closed = True
+        self._wakeup.set()
+
+    def submit(self, *args):
+        # replaces any call still waiting, only the most recent one runs
+        with self._lock:
+            self._args = args
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            with self._lock:
+                args, self._args = self._args, None
+            if args is not None:
+                self.fn(*args)
+
+
+class PipelineStage:
+    def __init__(self, fn, maxsize=0):
+        self.fn = fn
+        self.error = None
+        # bounded so a fast producer blocks instead of running far ahead of the consumer
+        self._items = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, *args):
+        self._items.put(args)
+
+    def _run(self):
+        while True:
+            args = self._items.get()
+            if args is None:
+                return
+            if self.error is None:
+                try:
+                    self.fn(*args)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        # waits until every queued item has been processed
+        self._items.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the worker always stops, an error from the with block wins over one from the stage
+        if exc_type is None:
+            self.close()
+        else:
+            self._items.put(None)
+            self._thread.join()
+
+
+ABBREVIATIONS = {
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'e.g', 'i.e', 'approx',
+    'fig', 'inc', 'ltd', 'co', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep',
+    'sept', 'oct', 'nov', 'dec', 'mt', 'ft', 'u.s', 'u.k', 'a.m', 'p.m'
+}
+
+
+class SentenceSegmenter:
+    # terminal punctuation, closing quotes or brackets, then whitespace; the whitespace must
+    # already be in the buffer so "3." waits to see whether "14" follows
+    sentence_end = re.compile(r'[.!?\u2026]+["\'\u201d\u2019)\]]*(?=\s)|\n')
+    clause_end = re.compile(r'[,;:\u2014]+(?=\s)|\s[-\u2013\u2014]\s')
+
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.first_min_chars = self.params.get('first_min_chars', None)
+        self.min_chars = self.params.get('min_chars', None)
+        self.max_chars = self.params.get('max_chars', None)
+        self.reset()
+
+    def reset(self):
+        self.buffer = ""
+        self.n_chunks = 0
+        self._scan_pos = 0
+
+    def feed(self, text):
+        self.buffer += text
+        chunks = []
+        while True:
+            end = self._find_split()
+            if end is None:
+                break
+            chunks.append(self._take(end))
+        return [chunk for chunk in chunks if chunk]
+
+    def flush(self):
+        chunk = self._take(len(self.buffer))
+        self.reset()
+        return [chunk] if chunk else []
+
+    def _take(self, end):
+        chunk = self.buffer[:end].strip()
+        self.buffer = self.buffer[end:]
+        self._scan_pos = 0
+        if chunk:
+            self.n_chunks += 1
+        return chunk
+
+    def _is_abbreviation(self, pos, end):
+        # pos is the index of a "." closing the word before it, None until the next word shows
+        words = self.buffer[:pos].split()
+        if not words:
+            return False
+        word = words[-1].lstrip('("\'')
+        if word.lower() in ABBREVIATIONS:
+            return True
+        if word.lower() != 'no' and not (len(word) == 1 and word.isupper() and word != 'I'):
+            return False
+        if word.lower() != 'no' and len(words) > 1 and not words[-2].lstrip('("\'')[:1].isupper():
+            # initials follow a name or another initial, "plan B." ends its sentence
+            return False
+        following = self.buffer[end:].lstrip()[:1]
+        if not following:
+            return None
+        # "No. 5" and initials as in "J. Smith", while "say no." ends its sentence
+        return following.isdigit() if word.lower() == 'no' else following.isupper()
+
+    def _find_split(self):
+        min_chars = self.first_min_chars if self.n_chunks == 0 else self.min_chars
+        last_clause = None
+        rescan_pos = None
+        for match in self.sentence_end.finditer(self.buffer, self._scan_pos):
+            if match.group().startswith('.') and len(match.group().rstrip('"\'\u201d\u2019)]')) == 1:
+                abbreviation = self._is_abbreviation(match.start(), match.end())
+                if abbreviation is None:
+                    rescan_pos = match.start()
+                    break
+                if abbreviation:
+                    continue
+            if len(self.buffer[:match.end()].strip()) >= min_chars:
+                return match.end()
+        for match in self.clause_end.finditer(self.buffer):
+            if match.end() > self.max_chars:
+                break
+            # only the first chunk splits on clauses early, later ones only to stay under max_chars
+            if self.n_chunks == 0 and len(self.buffer[:match.end()].strip()) >= min_chars:
+                return match.end()
+            last_clause = match.end()
+        if len(self.buffer) > self.max_chars:
+            if last_clause is not None:
+                return last_clause
+            space = self.buffer.rfind(' ', 0, self.max_chars)
+            return space if space > 0 else self.max_chars
+        # sentence ends that were too short are merged with what follows, only the unfinished last word needs a rescan
+        self._scan_pos = rescan_pos if rescan_pos is not None else re.search(r'\S*$', self.buffer).start()
+        return None
+
+
+class MarkdownStream:
+    # consumes streamed text once and returns (kind, text) spans, kind is prose, code or emphasis
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pending = ""
+        self.fence = False
+        self.inline_code = False
+        self.code_start = 0
+        self.code_open = 0
+        self.scan_pos = 0
+        self.emphasis = None
+        self.prev_char = "\n"
+        self.started = False
+
+    @property
+    def kind(self):
+        if self.fence or self.inline_code:
+            return "code"
+        return "emphasis" if self.emphasis else "prose"
+
+    def feed(self, text, final=False):
+        self.pending += text
+        spans = []
+        run_start = self.code_start + self.code_open if self.inline_code else 0
+        i = self.scan_pos
+        while i < len(self.pending) or (final and self.inline_code):
+            if self.inline_code and (i == len(self.pending) or self.pending[i] == "\n"):
+                # inline code ends at its line, an unclosed backtick was a stray one and is prose
+                self.inline_code = False
+                run_start = self.code_start
+                i = self.code_start + self.code_open
+                self.prev_char = "`"
+                continue
+            char = self.pending[i]
+            if char not in "`*_" or ((self.fence or self.inline_code) and char != "`"):
+                self.prev_char = char
+                i += 1
+                continue
+            run = len(self.pending[i:]) - len(self.pending[i:].lstrip(char))
+            if i + run == len(self.pending) and not final:
+                # a delimiter at the end may still grow with the next token
+                break
+            next_char = self.pending[i + run] if i + run < len(self.pending) else "\n"
+            if char == "`" and self.inline_code:
+                # inline code closes on a run as long as the one that opened it
+                toggles = run == self.code_open
+            elif char == "`":
+                # inside a fence only another fence closes it
+                toggles = run >= 3 or not self.fence
+            elif self.emphasis:
+                toggles = self.emphasis == char * run and not self.prev_char.isspace()
+            else:
+                toggles = not next_char.isspace() and not self.prev_char.isalnum() and run <= 2
+            if not toggles:
+                self.prev_char = char
+                i += run
+                continue
+            self._add_span(spans, self.pending[run_start:i])
+            if char == "`" and self.inline_code:
+                self.inline_code = False
+            elif char == "`" and run >= 3:
+                self.fence = not self.fence
+            elif char == "`":
+                self.inline_code = True
+                self.code_start = i
+                self.code_open = run
+            else:
+                self.emphasis = None if self.emphasis else char * run
+            self.prev_char = char
+            i += run
+            run_start = i
+        if self.inline_code:
+            # an inline span is held back until it closes, it may still turn out to be prose
+            self.pending = self.pending[self.code_start:]
+            self.scan_pos = i - self.code_start
+            self.code_start = 0
+        else:
+            self._add_span(spans, self.pending[run_start:i])
+            self.pending = self.pending[i:]
+            self.scan_pos = 0
+        return spans
+
+    def flush(self):
+        spans = self.feed("", final=True)
+        self.reset()
+        return spans
+
+    def _add_span(self, spans, text):
+        if not self.started:
+            # the answer starts at its first visible character
+            text = text.lstrip()
+            self.started = len(text) > 0
+        if not text:
+            return
+        if spans and spans[-1][0] == self.kind:
+            spans[-1] = (self.kind, spans[-1][1] + text)
+        else:
+            spans.append((self.kind, text))
@@ -1,55 +1,155 @@
-import torch
+import copy
+from collections import deque
+import numpy as np
 import onnxruntime as ort
+from . import silero
+
+
+class EnergyGate:
+    def __init__(self, params=None):
+        self.params = params or {}
+        self.enabled = self.params.get('enabled', None)
+        self.margin_db = self.params.get('margin_db', None)
+        self.silence_db = self.params.get('silence_db', None)
+        self.min_flatness = self.params.get('min_flatness', None)
+        self.min_zcr = self.params.get('min_zcr', None)
+        self.warmup_chunks = self.params.get('warmup_chunks', None)
+        self.floor_rise = self.params.get('floor_rise', None)
+        self.floor_fall = self.params.get('floor_fall', None)
+        self.initial_floor_db = self.params.get('initial_floor_db', None)
+        self.reset()
+
+    def reset(self):
+        self.noise_floor_db = self.initial_floor_db
+        self.gated_chunks = deque(maxlen=self.warmup_chunks)
+
+    def is_silent(self, chunk):
+        self.level_db = 10 * np.log10(np.mean(np.square(chunk)) + 1e-12)
+        if self.level_db < self.silence_db:
+            return True
+        if self.level_db > self.noise_floor_db + self.margin_db:
+            return False
+        # near the noise floor, only gate chunks that also look like noise
+        zcr = np.mean(np.abs(np.diff(np.signbit(chunk).astype(np.int8))))
+        power = np.square(np.abs(np.fft.rfft(chunk))) + 1e-12
+        flatness = np.exp(np.mean(np.log(power))) / np.mean(power)
+        return flatness > self.min_flatness or zcr > self.min_zcr
+
+    def update_floor(self):
+        # falls quickly, rises slowly, and only on chunks judged as non-speech
+        rate = self.floor_fall if self.level_db < self.noise_floor_db else self.floor_rise
+        self.noise_floor_db += rate * (self.level_db - self.noise_floor_db)
 
 
 class Vad:
     def __init__(self, params=None):
         self.params = params or {}
         self.samplerate = self.params.get('samplerate', None)
+        self.engine = self.params.get('engine', None)
+        self.model_url = self.params.get('model_url', None)
+        self.cache_dir = self.params.get('cache_dir', None)
+        self.num_threads = self.params.get('num_threads', None)
         self.repo_or_dir = self.params.get('repo_or_dir', None)
         self.model_name = self.params.get('model_name', None)
         self.force_reload = self.params.get('force_reload', None)
         self.use_onnx = self.params.get('use_onnx', None)
         self.no_voice_wait_sec = self.params.get('no_voice_wait_sec', None)
+        self.preroll_ms = self.params.get('preroll_ms', None)
+        self.stt_speech_only = self.params.get('stt_speech_only', None)
+        self.stt_min_silence_ms = self.params.get('stt_min_silence_ms', None)
+        self.pre_gate = EnergyGate(params=self.params.get('pre_gate', None))
+        self.barge_in = self.params.get('barge_in', None) or {}
         self.onnx_verbose = self.params.get('onnx_verbose', None)
         self.verbose = self.params.get('verbose', None)
         
-        if self.use_onnx and not self.onnx_verbose:
+        if (self.engine != 'hub' or self.use_onnx) and not self.onnx_verbose:
             ort.set_default_logger_severity(3)
         
-        self.silero_vad_model, self.silero_utils = torch.hub.load(
-            repo_or_dir=self.repo_or_dir,
-            model=self.model_name,
-            force_reload=self.force_reload,
-            onnx=self.use_onnx,
-            trust_repo='check',
-            verbose=self.verbose
-        )
-        
-        (
-            self.get_speech_timestamps,
-            self.save_audio,
-            self.read_audio,
-            self.VADIterator,
-            self.collect_chunks,
-        ) = self.silero_utils
+        if self.engine == 'hub':
+            import torch
+            self.silero_vad_model, self.silero_utils = torch.hub.load(
+                repo_or_dir=self.repo_or_dir,
+                model=self.model_name,
+                force_reload=self.force_reload,
+                onnx=self.use_onnx,
+                trust_repo='check',
+                verbose=self.verbose
+            )
+            (
+                self.get_speech_timestamps,
+                self.save_audio,
+                self.read_audio,
+                self.VADIterator,
+                self.collect_chunks,
+            ) = self.silero_utils
+        else:
+            model_path = silero.download_model(self.model_url, self.cache_dir)
+            self.silero_vad_model = silero.SileroOnnx(model_path, num_threads=self.num_threads)
+            self.get_speech_timestamps = silero.get_speech_timestamps
+            self.VADIterator = silero.VADIterator
 
         self.no_voice_sec = 0
+        self.checked_chunks = 0
+        self.skipped_inferences = 0
+        self.barge_in_chunks = 0
         
-        self.vad_iterator = self.VADIterator(
-            self.silero_vad_model,
+        self.vad_iterator = self._make_iterator(self.silero_vad_model)
+
+    def _make_iterator(self, model):
+        return self.VADIterator(
+            model,
             threshold=0.5,
             sampling_rate=self.samplerate,
             min_silence_duration_ms=100,
             speech_pad_ms=30
-            ) 
+            )
+
+    def new_session(self):
+        # shares the loaded model, but not its recurrent state
+        session = copy.copy(self)
+        session.pre_gate = copy.copy(self.pre_gate)
+        session.checked_chunks = 0
+        session.skipped_inferences = 0
+        if self.engine == 'hub' and not self.use_onnx:
+            session.silero_vad_model = copy.deepcopy(self.silero_vad_model)
+        else:
+            session.silero_vad_model = copy.copy(self.silero_vad_model)
+        session.vad_iterator = self._make_iterator(session.silero_vad_model)
+        session.reset_vad()
+        return session
         
     def reset_vad(self):
         self.no_voice_sec = 0
-        self.vad_iterator.reset_states()   
+        self.barge_in_chunks = 0
+        self.vad_iterator.reset_states()
+        # chunks gated before the reset must not be replayed into the fresh model state
+        self.pre_gate.reset()
+
+    def _update_model(self, chunk):
+        # same input conversion as the engine's VADIterator, the hub model takes tensors
+        if self.engine == 'hub':
+            import torch
+            chunk = torch.as_tensor(chunk)
+        self.silero_vad_model(chunk, self.samplerate)
 
     def check(self, mic_chunk, chunk_time):
-        speech_dict = self.vad_iterator(mic_chunk, return_seconds=False)
+        self.checked_chunks += 1
+        gate = self.pre_gate.enabled and not self.vad_iterator.triggered
+        if gate and self.pre_gate.is_silent(mic_chunk):
+            # keep the iterator's sample clock running as if the model had seen the chunk
+            self.vad_iterator.current_sample += len(mic_chunk)
+            self.skipped_inferences += 1
+            self.pre_gate.update_floor()
+            self.pre_gate.gated_chunks.append(mic_chunk)
+            speech_dict = None
+        else:
+            # the model needs a little recent context to respond at onset
+            while self.pre_gate.gated_chunks:
+                self._update_model(self.pre_gate.gated_chunks.popleft())
+                self.skipped_inferences -= 1
+            speech_dict = self.vad_iterator(mic_chunk, return_seconds=False)
+            if gate and speech_dict is None and not self.vad_iterator.triggered:
+                self.pre_gate.update_floor()
         if speech_dict is not None:
             if "start" in speech_dict:
                 self.no_voice_sec = 0
@@ -65,3 +165,28 @@ class Vad:
             elif not self.vad_iterator.triggered:
                 return None
         return "vad_continue"
+
+    def check_barge_in(self, mic_chunk, chunk_time, playback_level):
+        # while Aria speaks, only chunks clearly louder than her own echo reach the vad model
+        level = np.sqrt(np.mean(np.square(mic_chunk)))
+        if level > self.barge_in.get('echo_ratio', None) * playback_level:
+            vad_status = self.check(mic_chunk, chunk_time)
+        else:
+            vad_status = None
+        self.barge_in_chunks = self.barge_in_chunks + 1 if vad_status is not None else 0
+        return vad_status, self.barge_in_chunks >= self.barge_in.get('min_speech_chunks', None)
+
+    def trim_for_stt(self, data):
+        if not self.stt_speech_only or len(data) == 0:
+            return data
+        speech_timestamps = self.get_speech_timestamps(
+            data,
+            self.silero_vad_model,
+            sampling_rate=self.samplerate,
+            min_silence_duration_ms=self.stt_min_silence_ms,
+            speech_pad_ms=self.preroll_ms
+            )
+        self.reset_vad()
+        if len(speech_timestamps) == 0:
+            return data
+        return np.concatenate([data[ts['start']:ts['end']] for ts in speech_timestamps])
@@ -3,12 +3,11 @@ import logging
 logging.basicConfig(level=logging.INFO)
 import argparse
 import json
-import time
 import threading
-from copy import deepcopy
 from os.path import join
 from components.vad import Vad
 from components.stt import Stt
+from components.stt import StreamingStt
 from components.llm import Llm
 from components.tts import Tts
 from components.ap import Ap
@@ -16,8 +15,8 @@ from components.mic import Mic
 from components.ui import Ui
 from components.utils import remove_emojis
 from components.utils import remove_multiple_dots
-from components.utils import remove_code_blocks
-from components.utils import find_code_blocks
+from components.utils import parse_markdown
+from components.utils import LatestWorker
 # import scipy.io.wavfile as wf
 
 
@@ -26,6 +25,34 @@ def load_config(config_file):
         json_data = json.load(file)
     return json_data
 
+def answer(ui, ap, llm, tts, stt_data, cancel=None):
+    if len(stt_data) != 1:
+        ui.add_message("You", stt_data, new_entry=True)
+        print("You:", stt_data)
+        print("🤖...", end=" ")
+        llm_data = llm.get_answer(ui, ap, tts, stt_data, cancel=cancel)
+        if not llm.streaming_output:
+            print("Aria:", llm_data)
+            spans = parse_markdown(llm_data)
+            ui.add_message("Aria", "", new_entry=True)
+            for kind, text in spans:
+                ui.add_message("Aria", text, new_entry=False, kind=kind)
+            tts.text_splitting = True
+            txt_for_tts = remove_emojis(remove_multiple_dots("".join(text for kind, text in spans if kind != "code")))
+            if not all(char.isspace() for char in txt_for_tts):
+                tts.run_tts(txt_for_tts, cancel=cancel)
+                ap.check_audio_finished()
+    else:
+        # TODO add to llm context
+        ui.add_message("You", "...", new_entry=True)
+        print("You: ...")
+        ui.add_message("Aria", "Did you say something?", new_entry=True)
+        print("🤖... Aria:", "Did you say something?")
+        tts.run_tts("Did you say something?", cancel=cancel)
+        ap.check_audio_finished()
+    if cancel is None or not cancel.is_set():
+        ap.play_sound(ap.listening_sound)
+
 def main(ui, config):
     vad_params = config.get("Vad", {}).get("params", {})
     stt_params = config.get("Stt", {}).get("params", {})
@@ -43,86 +70,122 @@ def main(ui, config):
     ap = Ap(params=ap_params, ui=ui)
     tts = Tts(params=tts_params, ap=ap)
     mic = Mic(params=mic_params, ui=ui, vad_params=vad_params)
+    stt_stream = None
+    prefill_worker = None
+    if stt.streaming.get('enabled', None):
+        on_partial = None
+        if llm.speculative_prefill:
+            prefill_worker = LatestWorker(llm.prefill)
+            on_partial = prefill_worker.submit
+        stt_stream = StreamingStt(stt, params=stt.streaming, samplerate=mic.samplerate, on_partial=on_partial)
     
     mic_muted = False
-    mic_last_chunk = None
+    barge_in = vad.barge_in.get('enabled', None)
+    answer_thread = None
+    cancelled_thread = None
+    cancel = None
     ap.play_sound(ap.listening_sound)
     ui.load_visual("You")
     ui.add_message("system", "\nReady...", new_entry=False)
     print('Ready...\n\n🎙...', end= " ")
     mic.start_mic()
     while True:
-        skip_sleep = False
         if ui.kill:
             print("\nShutting down...")
+            if cancel is not None:
+                cancel.set()
+            if prefill_worker is not None:
+                prefill_worker.close()
+            if vad.pre_gate.enabled:
+                print("VAD inferences skipped by pre-gate:", vad.skipped_inferences, "of", vad.checked_chunks)
+            if llm.cache is not None:
+                print("LLM prefix cache hits:", llm.cache.hits, "of", llm.cache.lookups, "reused prompt tokens:", llm.cache.reused_tokens, "dropped disk writes:", llm.cache.dropped_writes)
+            print("Playback underruns:", ap.underruns, "device underflows:", ap.device_underruns)
             break
-        mic_chunk = mic.get_chunk()
-        if len(mic_chunk) == mic.buffer_size:
-            if max(mic_chunk) == 0 and not mic_muted:
+        mic_chunk = mic.get_chunk(timeout=0.1)
+        if mic_chunk is not None:
+            if mic_chunk.max() == 0 and not mic_muted:
                 mic_muted = True
                 mic.update_ui = False
                 ui.load_visual("system_muted_mic")
                 vad.reset_vad()
                 mic.reset_recording()
-                skip_sleep = True
-            elif not (mic_chunk==mic_last_chunk).all() and max(mic_chunk) != 0:
+                if stt_stream is not None:
+                    stt_stream.reset()
+            elif mic_chunk.max() != 0:
                 if mic_muted:
                     ui.load_visual("You")
                     mic.update_ui = True
                     mic_muted = False
-                mic_last_chunk = deepcopy(mic_chunk)
-                mic.vad_time = vad.no_voice_wait_sec - vad.no_voice_sec
-                vad_status = vad.check(mic_chunk, mic.buffer_size / mic.samplerate)
+                chunk_time = mic.buffer_size / mic.samplerate
+                if answer_thread is not None and answer_thread.is_alive():
+                    # Aria is speaking, her own voice must not open a turn
+                    vad_status, barged_in = vad.check_barge_in(mic_chunk, chunk_time, ap.output_level)
+                    if not barged_in:
+                        if vad_status is None:
+                            mic.reset_recording(keep_sec=vad.preroll_ms / 1000)
+                        continue
+                    # stops llama.cpp and xtts at their next token or chunk, and playback right away
+                    cancel.set()
+                    ap.clear()
+                    ap.check_audio_finished()
+                    cancelled_thread = answer_thread
+                    answer_thread = None
+                    ui.load_visual("You")
+                    print("\n🎙...", end=" ")
+                    mic.update_ui = True
+                else:
+                    if answer_thread is not None:
+                        answer_thread = None
+                        vad.reset_vad()
+                        ui.load_visual("You")
+                        print("\n🎙...", end=" ")
+                        mic.update_ui = True
+                    mic.vad_time = vad.no_voice_wait_sec - vad.no_voice_sec
+                    vad_status = vad.check(mic_chunk, chunk_time)
+                if stt_stream is not None:
+                    if vad_status is None:
+                        if not stt_stream.is_empty():
+                            stt_stream.reset()
+                    elif stt_stream.is_empty():
+                        # the first chunk brings the pre-roll kept in the recording
+                        stt_stream.feed(mic.get_recording())
+                    else:
+                        stt_stream.feed(mic_chunk)
                 if vad_status is None:
-                    mic.reset_recording()
-                    skip_sleep = True
+                    mic.reset_recording(keep_sec=vad.preroll_ms / 1000)
                 elif vad_status == "vad_end":
-                    mic.stop_mic()
+                    if not barge_in:
+                        mic.stop_mic()
                     ui.load_visual("system_transition")
                     ap.play_sound(ap.transition_sound)
-                    mic_recording = mic.get_recording()
-                    mic_recording = mic_recording[:-vad.no_voice_wait_sec*mic.samplerate]
-                    # wf.write('test.wav', mic.samplerate, mic_recording)
-                    stt_data = stt.transcribe_translate(mic_recording)
-                    if len(stt_data) != 1:
-                        ui.add_message("You", stt_data, new_entry=True)
-                        print("You:", stt_data)
-                        print("🤖...", end=" ")
-                        llm_data = llm.get_answer(ui, ap, tts, stt_data)
-                        if not llm.streaming_output:
-                            print("Aria:", llm_data)
-                            code_blocks = find_code_blocks(llm_data)
-                            if len(code_blocks) > 0:
-                                color_code_block = True
-                            else:
-                                color_code_block = False
-                            ui.add_message("Aria", llm_data, new_entry=True, color_code_block=color_code_block, code_blocks=code_blocks)
-                            tts.text_splitting = True
-                            # TODO handle emphasis
-                            txt_for_tts = remove_emojis(remove_multiple_dots(remove_code_blocks(llm_data)))
-                            if not all(char.isspace() for char in txt_for_tts):
-                                tts.run_tts(txt_for_tts)
-                                ap.check_audio_finished()
+                    if stt_stream is not None:
+                        stt_data = stt_stream.finish(trim_sec=vad.no_voice_wait_sec, preprocess=vad.trim_for_stt)
                     else:
-                        # TODO add to llm context
-                        ui.add_message("You", "...", new_entry=True)
-                        print("You: ...")
-                        ui.add_message("Aria", "Did you say something?", new_entry=True)
-                        print("🤖... Aria:", "Did you say something?")
-                        tts.run_tts("Did you say something?")
-                        ap.check_audio_finished()
-                    time.sleep(1)
-                    ap.play_sound(ap.listening_sound)
-                    ui.load_visual("You")
-                    print("\n🎙...", end=" ")
-                    mic.start_mic()
-                    skip_sleep = True
+                        mic_recording = mic.get_recording()
+                        mic_recording = mic_recording[:-vad.no_voice_wait_sec*mic.samplerate]
+                        mic_recording = vad.trim_for_stt(mic_recording)
+                        # wf.write('test.wav', mic.samplerate, mic_recording)
+                        stt_data = stt.transcribe_translate(mic_recording)
+                    if barge_in:
+                        if cancelled_thread is not None:
+                            # the interrupted answer stores its partial reply before the next user message
+                            cancelled_thread.join(timeout=vad.barge_in.get('join_timeout_sec', None))
+                            cancelled_thread = None
+                        # the mic keeps running so the user can talk over the answer
+                        mic.update_ui = False
+                        cancel = threading.Event()
+                        answer_thread = threading.Thread(target=answer, args=(ui, ap, llm, tts, stt_data, cancel), daemon=True)
+                        answer_thread.start()
+                    else:
+                        answer(ui, ap, llm, tts, stt_data)
+                        ui.load_visual("You")
+                        print("\n🎙...", end=" ")
+                        mic.start_mic()
                 else:
                     pass
             else:
                 pass
-        if not skip_sleep:
-            time.sleep(mic.buffer_size / mic.samplerate)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Aria.")